@@ -8,8 +8,9 @@ import os
 import sys
 import traceback
 import glob
+import argparse
 
-from worldbuilder.util import extend, zero_hash, sha256hex, exists, mkdir, writefile
+from worldbuilder.util import extend, zero_hash, sha256hex, exists, mkdir, writefile, readfile
 from worldbuilder.submodule import global_mods
 from worldbuilder import commands
 
@@ -18,17 +19,116 @@ from worldbuilder import crosscompile
 
 from worldbuilder.linux import LinuxSrc, Linux
 from worldbuilder.coreboot import CorebootSrc, Coreboot
+from worldbuilder.distributed import Coordinator, Worker
+from worldbuilder.daemon import Daemon
+from worldbuilder.treecache import TreeCache
+from worldbuilder.configcache import ConfigureCache
+from worldbuilder.pressure import Pressure
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-m', '--max-modules',
+	dest='max_modules', type=int,
+	default=os.getenv("MAX_MODULES", None),
+	help="Maximum number of modules to build at once (or $MAX_MODULES in the environment)")
+parser.add_argument('--prep-jobs',
+	dest='prep_jobs', type=int,
+	default=os.getenv("PREP_JOBS", 4),
+	help="Number of modules to fetch, unpack and patch at once (or $PREP_JOBS in the environment)")
+parser.add_argument('--fetch-jobs',
+	dest='fetch_jobs', type=int,
+	default=os.getenv("FETCH_JOBS", 4),
+	help="Number of tarballs to download at once for the fetch command (or $FETCH_JOBS in the environment)")
+parser.add_argument('--recompress',
+	dest='recompress', action='store_true',
+	default=bool(os.getenv("RECOMPRESS", None)),
+	help="Keep a zstd copy of each tarball that is faster to unpack (or $RECOMPRESS in the environment)")
+parser.add_argument('--tree-cache',
+	dest='tree_cache', type=str,
+	default=os.getenv("TREE_CACHE", None),
+	help="Keep up to this much of patched source trees for the dirty modules, like 20G (or $TREE_CACHE in the environment)")
+parser.add_argument('--configure-cache',
+	dest='configure_cache', action='store_true',
+	default=bool(os.getenv("CONFIGURE_CACHE", None)),
+	help="Share the autoconf results between modules with the same toolchain (or $CONFIGURE_CACHE in the environment)")
+parser.add_argument('-k', '--keep-going',
+	dest='keep_going', action='store_true',
+	default=bool(os.getenv("KEEP_GOING", None)),
+	help="Keep building everything that does not depend on a failed module (or $KEEP_GOING in the environment)")
+parser.add_argument('--pressure',
+	dest='pressure', type=str,
+	default=None,
+	help="Hold back new modules above these limits, like memory=10,io=60,load=16,cpu=90 or none, the default is memory=10,io=60 (or $PRESSURE_LIMITS in the environment)")
+parser.add_argument('-B', '--build-dir',
+	dest='build_dir', type=str,
+	default=os.getenv("BUILD_DIR", "build"),
+	help="Directory for all of the build products (or $BUILD_DIR in the environment)")
+parser.add_argument('--coordinator',
+	dest='coordinator', type=int,
+	default=None,
+	help="Send the modules to remote workers that connect to this port")
+parser.add_argument('--bind',
+	dest='bind', type=str,
+	default=os.getenv("COORDINATOR_BIND", "127.0.0.1"),
+	help="Address for the coordinator to listen on, 0.0.0.0 for all (or $COORDINATOR_BIND in the environment, default 127.0.0.1)")
+parser.add_argument('--worker',
+	dest='worker', type=str,
+	default=None,
+	help="Build modules for the coordinator at this URL")
+parser.add_argument('--secret-file',
+	dest='secret_file', type=str,
+	default=os.getenv("HEADS_SECRET_FILE", None),
+	help="File with the secret shared by the coordinator and workers (or $HEADS_SECRET or $HEADS_SECRET_FILE in the environment)")
+parser.add_argument('--worker-timeout',
+	dest='worker_timeout', type=int,
+	default=os.getenv("WORKER_TIMEOUT", 600),
+	help="Seconds that a module can wait for a worker before it fails (or $WORKER_TIMEOUT in the environment)")
+parser.add_argument('--socket',
+	dest='socket', type=str,
+	default=os.getenv("HEADS_SOCKET", None),
+	help="Unix socket for the daemon command (or $HEADS_SOCKET in the environment, default BUILD_DIR/heads.sock)")
+parser.add_argument('--preflight',
+	dest='preflight', action='store_true',
+	default=bool(os.getenv("PREFLIGHT", None)),
+	help="Check that all of the patches apply before building anything (or $PREFLIGHT in the environment)")
+parser.add_argument('--build',
+	dest='build', action='store_true',
+	help="Build the modules listed by the affected command")
+parser.add_argument('targets', nargs='*',
+	help="Modules to build, or one of cache, check, fetch, history, preflight, verify-hashes, watch, daemon or affected FILES...")
+args = parser.parse_args()
+
+try:
+	pressure = Pressure(args.pressure)
+except ValueError as e:
+	parser.error("--pressure: " + str(e))
+
+worldbuilder.submodule.set_build_dir(args.build_dir)
 
 # cache server can be passed in the environment
 worldbuilder.submodule.cache_server = os.getenv("CACHE_SERVER", None)
+worldbuilder.submodule.ftp_store = os.getenv("FTP_STORE", None)
+worldbuilder.submodule.recompress = args.recompress
+if args.tree_cache:
+	worldbuilder.submodule.tree_cache = TreeCache(os.path.join(args.build_dir, "trees"), args.tree_cache)
+if args.configure_cache:
+	worldbuilder.submodule.autoconf_cache = ConfigureCache(
+		os.path.join(args.build_dir, "configure-cache"),
+		exclude = os.getenv("CONFIGURE_CACHE_EXCLUDE", "").split(","),
+		file_hash = worldbuilder.submodule.hash_cache.file_hash,
+	)
 
-for modname in sorted(glob.glob("modules/*")):
+def load_module(modname):
 	try:
 		with open(modname, "r") as f:
-			exec(f.read())
+			exec(compile(f.read(), modname, "exec"), globals())
+		return True
 	except Exception as e:
 		print(modname + ": failed to parse", file=sys.stderr)
 		print(traceback.format_exc(), file=sys.stderr)
+		return False
+
+for modname in sorted(glob.glob("modules/*")):
+	if not load_module(modname):
 		exit(1)
 
 def Heads(
@@ -121,15 +221,77 @@ x230_firmware = Heads(
 
 builder = worldbuilder.Builder([ qemu_firmware, x230_firmware ])
 
+if args.max_modules:
+	builder.max_modules = int(args.max_modules)
 if os.getenv("SINGLE_THREAD", None):
 	builder.single_thread = True
+builder.keep_going = args.keep_going
+builder.prep_jobs = int(args.prep_jobs)
+builder.fetch_jobs = int(args.fetch_jobs)
+builder.pressure = pressure
+builder.module_dir = "modules"
+builder.loader = load_module
 
-if len(sys.argv) > 1:
-	if sys.argv[1] == "cache":
-		exit(builder.cache_create("build/cache"))
-	elif sys.argv[1] == "check":
+if len(args.targets) > 0:
+	if args.targets[0] == "cache":
+		exit(builder.cache_create(worldbuilder.submodule.cache_dir))
+	elif args.targets[0] == "fetch":
+		exit(not builder.fetch_all())
+	elif args.targets[0] == "check":
 		exit(builder.check())
-	builder.mods = sys.argv[1:]
+	elif args.targets[0] == "preflight":
+		exit(not builder.preflight())
+	elif args.targets[0] == "verify-hashes":
+		exit(not worldbuilder.submodule.hash_cache.verify())
+	elif args.targets[0] == "history":
+		exit(not worldbuilder.History(os.path.join(args.build_dir, "history.jsonl")).report())
+	elif args.targets[0] == "watch":
+		builder.watch([ "config", "patches", "modules" ])
+	elif args.targets[0] == "daemon":
+		socket_path = args.socket or os.path.join(args.build_dir, "heads.sock")
+		exit(not Daemon(builder, socket_path, [ "config", "patches", "modules" ]).run())
+	elif args.targets[0] == "affected":
+		(affected, reasons) = builder.affected(args.targets[1:])
+		for mod in affected:
+			print(mod.fullname + ": " + reasons.get(mod.fullname, "depends on a changed module"))
+		if not args.build:
+			exit(0)
+		# the check above was of the whole graph, build only the
+		# affected modules and whatever they need
+		builder.mods = affected
+		builder.check()
+	else:
+		builder.mods = args.targets
+
+# the secret is read from a file so that it isn't on the command line
+secret = os.getenv("HEADS_SECRET", None)
+if args.secret_file:
+	secret = readfile(args.secret_file).decode('utf-8').strip()
+if (args.worker or args.coordinator) and not secret:
+	print("--coordinator and --worker need a shared secret in $HEADS_SECRET or --secret-file", file=sys.stderr)
+	exit(-1)
+
+if args.worker:
+	if not Worker(builder, args.worker, secret).run():
+		exit(-1)
+	exit(0)
+
+if args.preflight and not builder.preflight():
+	exit(-1)
+
+if args.coordinator:
+	builder.check()
+	builder.coordinator = Coordinator(builder, secret,
+		port = args.coordinator,
+		bind = args.bind,
+		worker_timeout = int(args.worker_timeout),
+	)
+	builder.coordinator.start()
+
+status = builder.build_all()
+
+if builder.coordinator:
+	builder.coordinator.stop()
 
-if not builder.build_all():
+if not status:
 	exit(-1)
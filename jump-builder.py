@@ -18,7 +18,7 @@ from localcompile import gcc, cross_tools_nocc, cross_tools, cross, target_arch
 for modname in glob("modules/*"):
 	try:
 		with open(modname, "r") as f:
-			exec(f.read())
+			exec(compile(f.read(), modname, "exec"))
 	except Exception as e:
 		print(modname + ": failed to parse", file=sys.stderr)
 		print(traceback.format_exc(), file=sys.stderr)
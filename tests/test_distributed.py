@@ -0,0 +1,159 @@
+# Runs a coordinator and workers on localhost in separate processes,
+# each with its own build directory, and builds a small graph with them.
+import os
+import sys
+import time
+import socket
+import tempfile
+import subprocess
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top_dir)
+
+import requests
+
+secret = "test-secret"
+
+# the same graph on every side: four leaves that take a moment to
+# build and a top module that needs the install trees of all of them
+driver_script = """
+import os, sys
+sys.path.insert(0, %(top_dir)r)
+import worldbuilder
+from worldbuilder import Submodule, Builder, submodule
+from worldbuilder.distributed import Coordinator, Worker
+
+(role, build_dir, port, lease, worker_timeout) = sys.argv[1:6]
+submodule.set_build_dir(build_dir)
+
+leaves = []
+for i in range(4):
+	leaves.append(Submodule("leaf%%d" %% (i), version="1",
+		make = [ "sleep", "1" ],
+		install = [ "sh", "-c", "echo %%(name)s > %%(install_dir)s/out" ],
+	))
+top = Submodule("top", version="1",
+	depends = leaves,
+	make = [ "true" ],
+	install = [ "sh", "-c", "cat " + " ".join("%%(" + leaf.name + ".install_dir)s/out" for leaf in leaves) + " > %%(install_dir)s/out" ],
+)
+
+builder = Builder([ top ])
+url = "http://127.0.0.1:" + port
+if role == "coordinator":
+	builder.check()
+	builder.coordinator = Coordinator(builder, %(secret)r, port=int(port), lease=float(lease), worker_timeout=float(worker_timeout))
+	builder.coordinator.start()
+	ok = builder.build_all()
+	builder.coordinator.stop()
+	sys.exit(0 if ok else 1)
+else:
+	sys.exit(0 if Worker(builder, url, %(secret)r, name=role, lease=float(lease)).run() else 1)
+"""
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+class DistributedTest(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.script = os.path.join(self.tmp.name, "driver.py")
+		with open(self.script, "w") as f:
+			f.write(driver_script % { "top_dir": top_dir, "secret": secret })
+		self.port = free_port()
+		self.url = "http://127.0.0.1:%d" % (self.port)
+		self.procs = []
+		self.logs = []
+
+	def tearDown(self):
+		for p in self.procs:
+			if p.poll() is None:
+				p.kill()
+			p.wait()
+		for log in self.logs:
+			log.close()
+		self.tmp.cleanup()
+
+	def start(self, role, lease=300, worker_timeout=60):
+		log = open(os.path.join(self.tmp.name, role + ".log"), "w")
+		self.logs.append(log)
+		p = subprocess.Popen([ sys.executable, self.script, role, os.path.join(self.tmp.name, role), str(self.port), str(lease), str(worker_timeout) ],
+			stdout=log, stderr=subprocess.STDOUT)
+		self.procs.append(p)
+		return p
+
+	def log(self, role):
+		with open(os.path.join(self.tmp.name, role + ".log")) as f:
+			return f.read()
+
+	def wait_for_coordinator(self):
+		for i in range(100):
+			try:
+				requests.post(self.url + "/renew/none/none", timeout=5)
+				return
+			except requests.exceptions.ConnectionError:
+				time.sleep(0.2)
+		self.fail("coordinator did not start\n" + self.log("coordinator"))
+
+	def check_result(self, coordinator):
+		self.assertEqual(coordinator.wait(120), 0, self.log("coordinator"))
+		install_dir = os.path.join(self.tmp.name, "coordinator", "install", "top-1")
+		(out_hash,) = os.listdir(install_dir)
+		with open(os.path.join(install_dir, out_hash, "out")) as f:
+			self.assertEqual(f.read(), "leaf0\nleaf1\nleaf2\nleaf3\n")
+
+	def test_two_workers(self):
+		coordinator = self.start("coordinator")
+		self.wait_for_coordinator()
+
+		# anything without the secret is turned away
+		for headers in [ {}, { "X-Heads-Secret": "wrong" } ]:
+			self.assertEqual(requests.get(self.url + "/work", params={ "worker": "intruder" }, headers=headers).status_code, 403)
+			self.assertEqual(requests.post(self.url + "/renew/leaf0-1/0", headers=headers).status_code, 403)
+			self.assertEqual(requests.get(self.url + "/artifact/leaf0-1/0", headers=headers).status_code, 403)
+			self.assertEqual(requests.put(self.url + "/result/leaf0-1/0", data=b'x', headers=headers).status_code, 403)
+		self.assertEqual(requests.post(self.url + "/renew/leaf0-1/0", headers={ "X-Heads-Secret": secret }).status_code, 404)
+
+		workers = [ self.start("worker1"), self.start("worker2") ]
+		self.check_result(coordinator)
+		for worker in workers:
+			self.assertEqual(worker.wait(60), 0)
+
+		log = self.log("coordinator")
+		self.assertIn("built by worker1", log)
+		self.assertIn("built by worker2", log)
+		self.assertIn("refused", log)
+
+	def test_stalled_worker(self):
+		# a worker that takes a job and then goes quiet loses it once
+		# the lease runs out, and another worker builds it
+		coordinator = self.start("coordinator", lease=2)
+		self.wait_for_coordinator()
+
+		stalled = None
+		for i in range(50):
+			r = requests.get(self.url + "/work", params={ "worker": "stalled" }, headers={ "X-Heads-Secret": secret }, timeout=60)
+			if r.status_code == 200:
+				stalled = r.json()
+				break
+		self.assertIsNotNone(stalled)
+
+		worker = self.start("worker1", lease=2)
+		self.check_result(coordinator)
+		self.assertEqual(worker.wait(60), 0)
+
+		log = self.log("coordinator")
+		self.assertIn(stalled["fullname"] + ": lost worker stalled, requeueing", log)
+		self.assertIn(stalled["fullname"] + ": built by worker1", log)
+
+	def test_no_workers(self):
+		# the jobs fail once nobody has taken them for worker_timeout
+		coordinator = self.start("coordinator", worker_timeout=2)
+		self.assertEqual(coordinator.wait(60), 1)
+		self.assertIn("no worker took the job in 2 seconds", self.log("coordinator"))
+
+if __name__ == "__main__":
+	unittest.main()
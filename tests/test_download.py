@@ -0,0 +1,156 @@
+# Tests for resuming interrupted downloads against a local HTTP server
+import os
+import sys
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top_dir)
+
+import requests
+from worldbuilder import util
+from worldbuilder import submodule
+from worldbuilder.submodule import Submodule
+
+data = bytes(range(256)) * 16384
+data_hash = hashlib.sha256(data).hexdigest()
+
+class Handler(BaseHTTPRequestHandler):
+	# how the server behaves is set by the test
+	honour_range = True
+	drop_after = None
+	requests = []
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		range_header = self.headers.get("Range")
+		Handler.requests.append(range_header)
+		start = 0
+		if range_header and self.honour_range:
+			start = int(range_header[len("bytes="):].rstrip("-"))
+			if start >= len(data):
+				self.send_response(416)
+				self.send_header("Content-Range", "bytes */%d" % (len(data)))
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				return
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+		else:
+			self.send_response(200)
+
+		body = data[start:]
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		if self.drop_after is not None:
+			# hang up partway through the body
+			self.wfile.write(body[:self.drop_after])
+			self.wfile.flush()
+			self.close_connection = True
+			return
+		self.wfile.write(body)
+
+class DownloadTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		cls.server.daemon_threads = True
+		threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+		cls.url = "http://127.0.0.1:%d/file.tar.xz" % (cls.server.server_address[1])
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+		Handler.honour_range = True
+		Handler.drop_after = None
+		Handler.requests = []
+		self.tmp = tempfile.TemporaryDirectory()
+		self.part = os.path.join(self.tmp.name, "file.tar.xz.part")
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def test_resume_with_range(self):
+		util.writefile(self.part, data[:100000])
+		self.assertEqual(util.download(self.url, self.part), data_hash)
+		self.assertEqual(Handler.requests, [ "bytes=100000-" ])
+		self.assertEqual(util.readfile(self.part), data)
+
+	def test_server_ignores_range(self):
+		# the whole file comes back, which must replace the part
+		Handler.honour_range = False
+		util.writefile(self.part, data[:100000])
+		self.assertEqual(util.download(self.url, self.part), data_hash)
+		self.assertEqual(Handler.requests, [ "bytes=100000-" ])
+		self.assertEqual(util.readfile(self.part), data)
+
+	def test_dropped_then_resumed(self):
+		Handler.drop_after = 2500000
+		with self.assertRaises(requests.exceptions.RequestException):
+			util.download(self.url, self.part)
+		kept = os.stat(self.part).st_size
+		# whatever arrived in whole chunks is kept for the next attempt
+		self.assertTrue(0 < kept <= 2500000)
+		self.assertEqual(util.readfile(self.part), data[:kept])
+
+		Handler.drop_after = None
+		self.assertEqual(util.download(self.url, self.part), data_hash)
+		self.assertEqual(Handler.requests[-1], "bytes=%d-" % (kept))
+		self.assertEqual(util.readfile(self.part), data)
+
+	def test_already_complete(self):
+		util.writefile(self.part, data)
+		self.assertEqual(util.download(self.url, self.part), data_hash)
+		self.assertEqual(Handler.requests, [ "bytes=%d-" % (len(data)) ])
+		self.assertEqual(util.readfile(self.part), data)
+
+	def test_bad_hash_after_resume(self):
+		# a corrupted prefix from an earlier attempt is only found
+		# once the rest has been appended; the file is set aside
+		mod = Submodule("download-test", version="1", url=self.url, tarhash=data_hash)
+		dest = os.path.join(self.tmp.name, "by-sha256", data_hash)
+		os.makedirs(os.path.dirname(dest))
+		util.writefile(dest + ".part", b'x' * 100000)
+		self.assertFalse(mod.fetch_file(self.url, dest))
+		self.assertEqual(Handler.requests, [ "bytes=100000-" ])
+		self.assertFalse(os.path.exists(dest))
+		self.assertFalse(os.path.exists(dest + ".part"))
+		self.assertEqual(os.stat(dest + ".bad").st_size, len(data))
+
+		# and the next attempt starts over
+		self.assertTrue(mod.fetch_file(self.url, dest))
+		self.assertEqual(util.readfile(dest), data)
+
+	def test_fetch_store(self):
+		# the tarball is stored by its hash with the lock kept outside
+		# of the store, and checking doesn't link the name back in
+		submodule.set_build_dir(os.path.join(self.tmp.name, "build"))
+		try:
+			ftp_dir = submodule.ftp_dir
+			mod = Submodule("fetch-test", version="1", url=self.url, tarhash=data_hash)
+			mod.update_hashes()
+			self.assertFalse(mod.fetch(check=True))
+			self.assertEqual(Handler.requests, [])
+
+			self.assertTrue(mod.fetch())
+			self.assertEqual(os.listdir(os.path.join(ftp_dir, "by-sha256")), [ data_hash ])
+			self.assertEqual(os.listdir(os.path.join(ftp_dir, "by-sha256.locks")), [ data_hash + ".lock" ])
+			self.assertTrue(os.path.samefile(os.path.join(ftp_dir, "file.tar.xz"), mod.tar_file))
+
+			os.unlink(os.path.join(ftp_dir, "file.tar.xz"))
+			self.assertTrue(mod.fetch(check=True))
+			self.assertFalse(os.path.exists(os.path.join(ftp_dir, "file.tar.xz")))
+			self.assertEqual(len(Handler.requests), 1)
+		finally:
+			submodule.set_build_dir("build")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,120 @@
+# Checks that the dependency graph queries scale linearly on synthetic
+# graphs with thousands of modules.
+import os
+import sys
+import time
+import random
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top_dir)
+
+from worldbuilder.graph import ModuleGraph
+
+class Node:
+	# just enough of a Submodule for the graph
+	def __init__(self, fullname, depends):
+		self.fullname = fullname
+		self.depends = depends
+		self.depends_spec = None
+
+def layered_graph(count, seed=1):
+	# every module depends on up to four earlier ones, mostly nearby
+	# so that the graph is deep as well as wide
+	rand = random.Random(seed)
+	mods = []
+	for i in range(count):
+		deps = set()
+		for j in range(min(i, rand.randint(0, 4))):
+			deps.add(mods[max(0, i - 1 - int(rand.expovariate(1 / 20.0)))])
+		mods.append(Node("mod%d" % (i), list(deps)))
+	return mods
+
+def best_time(func, repeat=3):
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		func()
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+class GraphTest(unittest.TestCase):
+	small = 2000
+	large = 32000
+	# linear would be 16, quadratic 256
+	max_ratio = 48
+
+	def check_order(self, mods):
+		position = { mod.fullname: i for (i, mod) in enumerate(mods) }
+		for mod in mods:
+			for dep in mod.depends:
+				if dep.fullname in position:
+					self.assertLess(position[dep.fullname], position[mod.fullname])
+
+	def test_small_graph(self):
+		mods = layered_graph(50)
+		graph = ModuleGraph()
+		closure = graph.closure([ mods[-1] ])
+		self.check_order(closure)
+		self.assertEqual(closure[-1], mods[-1])
+
+		# compared with the slow way of finding them
+		graph.closure(mods)
+		affected = graph.affected([ mods[10] ])
+		self.check_order(affected)
+		expected = { mods[10].fullname }
+		for mod in mods[11:]:
+			if any(dep.fullname in expected for dep in mod.depends):
+				expected.add(mod.fullname)
+		self.assertEqual(set(mod.fullname for mod in affected), expected)
+		self.assertEqual(affected[0], mods[10])
+
+	def test_deep_chain(self):
+		# one long chain doesn't hit the recursion limit
+		mods = [ Node("chain0", []) ]
+		for i in range(1, 50000):
+			mods.append(Node("chain%d" % (i), [ mods[-1] ]))
+		graph = ModuleGraph()
+		self.assertEqual(graph.closure([ mods[-1] ]), mods)
+		self.assertEqual(graph.affected([ mods[0] ]), mods)
+
+	def scaling(self, query):
+		times = []
+		for count in (self.small, self.large):
+			mods = layered_graph(count)
+			times.append(best_time(lambda: query(mods)))
+		ratio = times[1] / times[0]
+		self.assertLess(ratio, self.max_ratio,
+			"%d modules took %.4fs, %d took %.4fs" % (self.small, times[0], self.large, times[1]))
+
+	def test_closure_scaling(self):
+		self.scaling(lambda mods: ModuleGraph().closure(mods[-10:]))
+
+	def test_affected_scaling(self):
+		def query(mods):
+			graph = ModuleGraph()
+			graph.closure(mods)
+			graph.affected(mods[:10])
+		self.scaling(query)
+
+	def test_ordered_scaling(self):
+		def query(mods):
+			graph = ModuleGraph()
+			graph.closure(mods)
+			graph.ordered([ mod.fullname for mod in reversed(mods) ])
+		self.scaling(query)
+
+	def test_small_query_on_large_graph(self):
+		# a query that touches a few modules doesn't walk the rest
+		mods = layered_graph(self.large)
+		graph = ModuleGraph()
+		graph.closure(mods)
+		full = best_time(lambda: graph.affected(mods[:1]))
+		small = best_time(lambda: graph.affected(mods[-1:]))
+		self.assertEqual(graph.affected(mods[-1:]), mods[-1:])
+		self.assertLess(small * 100, full)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,101 @@
+# Tests for the make jobserver client, including a whole build that
+# runs under `make -jN` and has to hand all of the tokens back.
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+from unittest import mock
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top_dir)
+
+from worldbuilder.jobserver import JobServer
+
+# run by make with the jobserver fds; builds a few modules that each
+# take a token and then counts the tokens that are left in the pipe
+builder_script = """
+import os, sys, re
+sys.path.insert(0, %(top_dir)r)
+import worldbuilder
+from worldbuilder import Submodule, Builder, submodule
+submodule.set_build_dir(%(build_dir)r)
+
+mods = [ Submodule("job%%d" %% (i), version="1", make=[ "sleep", "0.3" ], install=[ "true" ]) for i in range(6) ]
+builder = Builder(mods)
+if not builder.build_all():
+	sys.exit(1)
+
+auth = re.findall(r"--jobserver-(?:auth|fds)=(\\S+)", os.environ["MAKEFLAGS"])[-1]
+if auth.startswith("fifo:"):
+	fd = w = os.open(auth[5:], os.O_RDWR | os.O_NONBLOCK)
+else:
+	(r,w) = [ int(x) for x in auth.split(",") ]
+	fd = os.open("/proc/self/fd/%%d" %% (r), os.O_RDONLY | os.O_NONBLOCK)
+tokens = b''
+try:
+	while True:
+		data = os.read(fd, 64)
+		if not data:
+			break
+		tokens += data
+except BlockingIOError:
+	pass
+os.write(w, tokens)
+print("TOKENS %%d" %% (len(tokens)))
+"""
+
+class JobServerTest(unittest.TestCase):
+	def test_create(self):
+		with mock.patch.dict(os.environ, { "MAKEFLAGS": "" }):
+			js = JobServer(jobs=3)
+			self.assertIn("--jobserver-auth=%d,%d" % (js.read_fd, js.write_fd), os.environ["MAKEFLAGS"])
+			tokens = [ js.acquire(), js.acquire() ]
+			self.assertEqual(tokens, [ b'+', b'+' ])
+			self.assertIsNone(js.acquire(stop=lambda: True))
+			for token in tokens:
+				js.release(token)
+
+	def test_stolen_token(self):
+		# another make can take the token after select() said that
+		# there is one, which must not leave acquire() stuck in read()
+		(r,w) = os.pipe()
+		js = JobServer(makeflags="-j4 --jobserver-auth=%d,%d" % (r, w))
+		stopping = threading.Event()
+		result = []
+		with mock.patch("select.select", lambda rlist, wlist, xlist, timeout: (rlist, [], [])):
+			thread = threading.Thread(target=lambda: result.append(js.acquire(stop=stopping.is_set)), daemon=True)
+			thread.start()
+			thread.join(1)
+			stopping.set()
+			thread.join(5)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual(result, [ None ])
+		os.close(r)
+		os.close(w)
+
+	@unittest.skipIf(shutil.which("make") is None, "make is not installed")
+	def test_make_tokens_returned(self):
+		jobs = 4
+		with tempfile.TemporaryDirectory() as tmp:
+			script = os.path.join(tmp, "build.py")
+			with open(script, "w") as f:
+				f.write(builder_script % { "top_dir": top_dir, "build_dir": os.path.join(tmp, "build") })
+			with open(os.path.join(tmp, "Makefile"), "w") as f:
+				f.write("all:\n\t+%s %s\n" % (sys.executable, script))
+
+			env = dict(os.environ)
+			env.pop("MAKEFLAGS", None)
+			env.pop("MFLAGS", None)
+			p = subprocess.run([ "make", "-s", "-j%d" % (jobs), "-C", tmp ],
+				stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, timeout=120)
+			output = p.stdout.decode('utf-8', 'replace')
+			self.assertEqual(p.returncode, 0, output)
+			self.assertIn("JOBS    using make jobserver", output)
+			# everything except for make's own implicit token
+			self.assertIn("TOKENS %d" % (jobs - 1), output)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -3,4 +3,5 @@
 from worldbuilder.submodule import Submodule
 from worldbuilder.initrd import Initrd
 from worldbuilder.builder import Builder
+from worldbuilder.history import History
 #from worldbuilder.commands import prefix_map, configure_cmd, kbuild_make
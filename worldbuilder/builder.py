@@ -2,47 +2,114 @@
 # TODO: have this drive the set of modules and name resolution
 
 from worldbuilder.util import *
-from worldbuilder.submodule import global_mods # TODO remove this
+from worldbuilder import submodule
 #from graphlib import TopologicalSorter  # requires python3.9
 from worldbuilder.graphlib_backport import TopologicalSorter # our own copy
-from threading import Thread
-from time import sleep
+from worldbuilder.jobserver import JobServer
+from worldbuilder.history import History
+from worldbuilder.pressure import Pressure
+from worldbuilder.graph import ModuleGraph
+from worldbuilder.watch import Watcher
+from threading import Thread, Condition, Lock
+from concurrent.futures import ThreadPoolExecutor
+import requests
 
 class Builder:
 	def __init__(self, mods):
 		self.mods = mods
 		self.failed = False
-		self.single_thread = False
+		self.max_modules = None
+		self.keep_going = False
+		self.prep_jobs = 4
+		self.hash_jobs = os.cpu_count() or 1
+		self.fetch_jobs = 4
+		self.jobserver = None
+		self.pressure = None
+		self.coordinator = None
+		self.history = None
+		self.priority = {}
+		self.graph = None
+		self.module_dir = None
+		self.loader = None
+		self.lock = Condition()
 		self.reset()
 
+	# building one module at a time is a pool with a single worker
+	@property
+	def single_thread(self):
+		return self.max_modules == 1
+
+	@single_thread.setter
+	def single_thread(self, value):
+		self.max_modules = 1 if value else None
+
 	def reset(self):
 		self.waiting = {}
 		self.building = {}
 		self.installed = {}
 		self.failed = {}
+		self.finished = []
+		self.ready = []
+		self.prepared = {}
+		self.start_times = {}
+		self.tokens = []
+		self.module_tokens = {}
+		self.implicit_token = True
+		self.stopping = False
+		self.throttled = None
+
+	def eta(self):
+		# the longest remaining chain, less the time that the
+		# modules currently building have already spent on it
+		remaining = 0
+		blocked = self.blocked()
+		for name in self.waiting:
+			if name in blocked:
+				continue
+			remaining = max(remaining, self.priority.get(name, 0))
+		for name in self.building:
+			elapsed = time.time() - self.start_times.get(name, time.time())
+			duration = self.history.duration(self.building[name])
+			remaining = max(remaining, self.priority.get(name, 0) - min(elapsed, duration))
+		return remaining
 
 	def report(self):
 		wait_list = ','.join(self.waiting)
 		building_list = ','.join(self.building)
 		installed_list = ','.join(self.installed)
 		failed_list = ','.join(self.failed)
+		eta = ""
+		if len(self.building) != 0 or (len(self.waiting) != 0 and len(self.failed) == 0):
+			eta = " eta=%d:%02d" % divmod(int(self.eta()) // 60, 60)
 		print(now(),
 			"building=[" + building_list
 			+ "] waiting=[" +  wait_list
 			+ "] installed=[" + installed_list
-			+ "]"
+			+ "]" + eta
 		)
 		if len(self.failed) > 0:
 			print(now(), "failed=" + failed_list, file=sys.stderr)
+			blocked = self.blocked()
+			if len(blocked) != 0:
+				print(now(), "blocked=" + ','.join(blocked), file=sys.stderr)
 			return False
 
 		return True
 
-	def _build_thread(self, mod):
+	def blocked(self):
+		# modules that can't be built since something that they
+		# depend on, directly or indirectly, has failed
+		blocked = {}
+		for mod in self.ordered_mods:
+			if not mod.fullname in self.waiting:
+				continue
+			for dep in mod.depends:
+				if dep.fullname in self.failed or dep.fullname in blocked:
+					blocked[mod.fullname] = mod
+					break
+		return blocked
 
-		del self.waiting[mod.fullname]
-		self.building[mod.fullname] = mod
-		#self.report()
+	def _build_thread(self, mod):
 		failed = False
 
 		try:
@@ -50,9 +117,10 @@ class Builder:
 			if mod.installed:
 				# nothing to do!
 				pass
-			elif mod.install():
-				self.installed[mod.fullname] = mod
-				print(now(), "DONE    " + mod.fullname + " (%d seconds)" % (time.time() - start_time))
+			elif self._install(mod):
+				build_time = time.time() - start_time
+				print(now(), "DONE    " + mod.fullname + " (%d seconds)" % (build_time))
+				self.history.record(mod, start_time, build_time)
 			else:
 				failed = True
 
@@ -61,14 +129,136 @@ class Builder:
 			failed = True
 
 		if failed:
-			self.failed[mod.fullname] = mod
+			self.history.record(mod, start_time, time.time() - start_time, ok=False)
 			print(now(), "FAILED! " + mod.fullname + ": logs are in " + relative(mod.last_logfile)) #, file=sys.stderr)
 			for line in readfile(mod.last_logfile).split(b'\n')[-20:-1]:
 				print(mod.fullname + ": " + line.decode('utf-8')) #, file=sys.stderr)
 			#print(mod.fullname, mod.dict)
 
-		del self.building[mod.fullname]
-		#self.report()
+		# hand the result back to the scheduler and wake it up
+		with self.lock:
+			del self.building[mod.fullname]
+			if failed:
+				self.failed[mod.fullname] = mod
+			else:
+				self.installed[mod.fullname] = mod
+			self.finished.append(mod)
+
+			# give back the jobserver token that this module used
+			token = self.module_tokens.pop(mod.fullname)
+			if token is None:
+				self.implicit_token = True
+			elif token is not False:
+				self.jobserver.release(token)
+
+			self.lock.notify_all()
+
+	def _remote(self, mod):
+		return self.coordinator is not None and self.coordinator.remote_ok(mod)
+
+	def _install(self, mod):
+		if self._remote(mod):
+			return self.coordinator.build(mod)
+		return mod.install()
+
+	def _prep_jobs(self):
+		# don't unpack more trees at once than modules can be built
+		if self.max_modules:
+			return max(1, min(self.prep_jobs, self.max_modules))
+		return self.prep_jobs
+
+	def _from_cache(self, mod):
+		# cacheable modules try the cache server first and only
+		# prepare their sources in install() if it doesn't have them
+		return mod.cacheable and submodule.cache_server
+
+	def _prepare_thread(self, mod):
+		# fetch, unpack and patch only depend on the module's own
+		# sources, so they can run before any dependencies are built
+		ok = False
+		try:
+			ok = mod.patch()
+		except Exception as e:
+			print(traceback.format_exc())
+
+		with self.lock:
+			if ok:
+				self.prepared[mod.fullname] = mod
+			else:
+				print(now(), "FAILED! " + mod.fullname + ": could not prepare sources")
+				del self.waiting[mod.fullname]
+				self.failed[mod.fullname] = mod
+				if mod in self.ready:
+					self.ready.remove(mod)
+			self.lock.notify_all()
+
+	def _runnable(self):
+		# ready modules that have their sources prepared
+		return [mod for mod in self.ready if mod.fullname in self.prepared]
+
+	def _start(self, mod):
+		# must be called with the lock held and a token available,
+		# remote builds don't use any of the local cpu budget
+		if self._remote(mod):
+			token = False
+		elif self.implicit_token:
+			self.implicit_token = False
+			token = None
+		else:
+			token = self.tokens.pop()
+
+		self.module_tokens[mod.fullname] = token
+		self.start_times[mod.fullname] = time.time()
+		del self.waiting[mod.fullname]
+		self.building[mod.fullname] = mod
+		mod.building = True
+		self.pool.submit(self._build_thread, mod)
+
+	def _available_tokens(self):
+		return len(self.tokens) + (1 if self.implicit_token else 0)
+
+	def _free_slots(self):
+		if self.throttled:
+			return 0
+		if self.max_modules is None:
+			return len(self.ready)
+		return max(0, self.max_modules - len(self.building))
+
+	def _tokens_wanted(self):
+		local = [mod for mod in self._runnable() if not self._remote(mod)]
+		return min(len(local), self._free_slots())
+
+	def _update_throttle(self):
+		# always allow one module to build so that the
+		# build can't stall forever on a busy machine
+		if len(self.building) == 0 or len(self._runnable()) == 0:
+			reason = None
+		else:
+			reason = self.pressure.check()
+
+		if reason and not self.throttled:
+			info("PRESSURE holding back new modules: " + reason)
+		elif not reason and self.throttled:
+			info("PRESSURE resuming")
+		self.throttled = reason
+
+	def _token_thread(self):
+		# reading from the jobserver blocks, so the tokens are collected
+		# in the background and handed to the scheduler on the condition
+		while True:
+			with self.lock:
+				while not self.stopping and self._tokens_wanted() <= self._available_tokens():
+					self.lock.wait()
+				if self.stopping:
+					return
+
+			token = self.jobserver.acquire(stop=lambda: self.stopping)
+			if token is None:
+				return
+
+			with self.lock:
+				self.tokens.append(token)
+				self.lock.notify_all()
 
 	def check(self):
 		# walk all the dependencies to ensure consistency of inputs
@@ -77,32 +267,11 @@ class Builder:
 		# build the transitive closure of all modules that are
 		# required, and sort them into a build order so that
 		# dependencies are maintained
-		ts = TopologicalSorter()
-
-		for mod in self.mods:
-			# lookup any strings-based dependencies
-			depends = []
-			if type(mod) == str:
-				if not mod in global_mods:
-					die(mod + ": not found?")
-				mod = global_mods[mod]
-
-			for dep in mod.depends:
-				if type(dep) == str:
-					if not dep in global_mods:
-						die(dep + ": not found? referenced by " + mod.fullname)
-					dep = global_mods[dep]
-				depends.append(dep)
-
-			mod.depends = depends
-					
-			ts.add(mod, *mod.depends)
-			for dep in mod.depends:
-				self.mods.append(dep)
-
-		self.ordered_mods = [*ts.static_order()]
+		self.graph = ModuleGraph()
+		self.ordered_mods = self.graph.closure(self.mods)
 		print([x.fullname for x in self.ordered_mods])
 
+		self.prehash(self.ordered_mods)
 		for mod in self.ordered_mods:
 			mod.update_hashes()
 			mod.install(check=True)
@@ -112,6 +281,8 @@ class Builder:
 				self.waiting[mod.fullname] = mod
 			print(mod.state() + " " + mod.fullname + ": " + relative(mod.out_dir))
 
+		submodule.hash_cache.save()
+		self.update_priority()
 		self.report()
 #		for modname, mod in self.built.items():
 #			print(mod.state() + " " + mod.name + ": " + mod.out_dir)
@@ -119,45 +290,391 @@ class Builder:
 #			print(mod.state() + " " + mod.name + ": " + mod.out_dir)
 
 
-	def build_all(self):
-		if len(self.waiting) == 0:
+	def prehash(self, mods):
+		# read and hash the patches and configs of all of the modules
+		# in parallel so that they are in the hash memo by the time
+		# that update_hashes() chains them together in order.  files
+		# that can't be hashed here are reported by update_hashes().
+		filenames = set()
+		for mod in mods:
+			filenames.update([os.path.abspath(f) for f in mod.input_files()])
+
+		def file_hash(filename):
+			try:
+				submodule.hash_cache.file_hash(filename)
+			except OSError:
+				pass
+
+		with ThreadPoolExecutor(max_workers = self.hash_jobs) as pool:
+			list(pool.map(file_hash, sorted(filenames)))
+
+	def affected(self, filenames):
+		# the modules that use any of these files, along with the
+		# reason, and all of the modules that depend on them
+		if self.graph is None:
 			self.check()
 
-		while True:
-			if len(self.waiting) == 0 or len(self.failed) != 0:
-				# no mods left, no builders? we're done!
-				if len(self.building) == 0:
-					return self.report()
-
-				# no mods left, and builds are in process,
-				# wait for completions. is there a better way?
-				sleep(1)
+		filenames = [os.path.abspath(filename) for filename in filenames]
+		reasons = {}
+		for mod in self.ordered_mods:
+			reason = mod.uses_files(filenames)
+			if reason:
+				reasons[mod.fullname] = reason
+
+		return (self.graph.affected(reasons), reasons)
+
+	def forget(self, filename):
+		# remove the modules that were defined by this file from
+		# the global list so that it can be loaded again
+		forgotten = {}
+		for (name, mod) in list(submodule.global_mods.items()):
+			if filename in mod.def_files:
+				forgotten[name] = submodule.global_mods.pop(name)
+		return forgotten
+
+	def reload(self, filenames):
+		# load the changed module definitions again; if any of them
+		# fail then the previous definitions are kept
+		module_dir = os.path.abspath(self.module_dir)
+		module_files = [filename for filename in filenames
+			if os.path.dirname(filename) == module_dir
+			and not os.path.basename(filename).startswith(".")]
+
+		forgotten = {}
+		for filename in module_files:
+			removed = self.forget(filename)
+			forgotten.update(removed)
+			if not exists(filename):
+				if len(removed) != 0:
+					info("REMOVED " + relative(filename))
 				continue
+			info("RELOAD  " + relative(filename))
+			if not self.loader(filename):
+				for filename in module_files:
+					self.forget(filename)
+				submodule.global_mods.update(forgotten)
+				return False
+		return True
 
-			if self.single_thread and len(self.building) != 0:
-				# let's wait for it to finish
-				sleep(0.1)
-				continue
+	def refresh(self, filenames):
+		# bring the graph that is in memory up to date after some
+		# files have changed, rehashing only the affected modules.
+		# returns False if the new module definitions are broken.
+		filenames = [os.path.abspath(filename) for filename in filenames]
+		if self.loader and self.module_dir and not self.reload(filenames):
+			return False
+
+		for name in self.mods:
+			if type(name) == str and not name in submodule.global_mods:
+				print(name + ": not found?", file=sys.stderr)
+				return False
+
+		# new module objects won't have been hashed yet, and the
+		# modules that depend on them will have to be rehashed
+		try:
+			graph = ModuleGraph()
+			ordered_mods = graph.closure(self.mods)
+		except SystemExit:
+			# missing module or a dependency cycle, which has
+			# already been reported
+			return False
+		self.graph = graph
+		self.ordered_mods = ordered_mods
+
+		changed = {}
+		for mod in self.ordered_mods:
+			reason = None if mod.ready else "defined"
+			reason = reason or mod.uses_files(filenames)
+			if reason:
+				info("CHANGED " + mod.fullname + ": " + reason)
+				changed[mod.fullname] = mod
+
+		affected = self.graph.affected(changed)
+		for mod in affected:
+			mod.invalidate()
+		self.prehash(affected)
+		for mod in affected:
+			mod.update_hashes()
+			mod.install(check=True)
+		submodule.hash_cache.save()
+
+		self.reset()
+		for mod in self.ordered_mods:
+			if mod.installed:
+				self.installed[mod.fullname] = mod
+			else:
+				self.waiting[mod.fullname] = mod
+
+		self.update_priority()
+		return True
 
-			for name in list(self.waiting):
-				mod = self.waiting[name]
-				ready = True
-				for dep in mod.depends:
-					if not dep.fullname in self.installed:
-						ready = False
+	def watch_files(self):
+		# the dependency files of all the modules, except the ones that
+		# are produced by other modules since they change on every build
+		top = os.path.abspath(submodule.build_dir)
+		files = []
+		for mod in self.ordered_mods:
+			for dep_file in mod.dep_files:
+				filename = os.path.abspath(mod.format(dep_file))
+				if not filename.startswith(top + "/"):
+					files.append(filename)
+		return files
+
+	def watch(self, dirs, settle=0.5):
+		# build everything, then keep the graph in memory and build
+		# whatever is affected each time the definitions change
+		if self.graph is None:
+			self.check()
+		watcher = Watcher(dirs, self.watch_files())
 
-				if not ready:
-					# oh well, try the next one
+		while True:
+			if len(self.waiting) != 0:
+				self.build_all()
+			info("WATCH   waiting for changes in " + ",".join(dirs))
+
+			filenames = watcher.wait(settle)
+			info("WATCH   %d files changed" % (len(filenames)))
+			while not self.refresh(filenames):
+				info("WATCH   fix the module definitions to continue")
+				filenames = sorted(set(filenames + watcher.wait(settle)))
+
+			watcher.add_files(self.watch_files())
+			self.report()
+
+	def update_priority(self):
+		# the priority of each module is the length of the longest
+		# chain of builds that it starts, using the durations from
+		# previous runs, so that the critical path goes first.
+		if self.history is None:
+			self.history = History(os.path.join(submodule.build_dir, "history.jsonl"))
+
+		self.priority = {}
+		for mod in reversed(self.ordered_mods):
+			if mod.fullname in self.installed:
+				duration = 0
+			else:
+				duration = self.history.duration(mod)
+
+			longest = 0
+			for user in self.graph.users.get(mod.fullname, []):
+				longest = max(longest, self.priority.get(user.fullname, 0))
+
+			self.priority[mod.fullname] = duration + longest
+
+	def build_all(self):
+		if len(self.waiting) == 0:
+			self.check()
+
+		# the topological sorter hands out the modules as soon as all
+		# of their dependencies have been marked done, so the scheduler
+		# only has to wake up when a build thread finishes.
+		ts = TopologicalSorter()
+		for mod in self.ordered_mods:
+			ts.add(mod, *mod.depends)
+		ts.prepare()
+
+		if self.jobserver is None:
+			self.jobserver = JobServer()
+		if self.pressure is None:
+			self.pressure = Pressure()
+
+		ready = self.ready
+		progress = False
+		self.pool = ThreadPoolExecutor(max_workers = self.max_modules or max(1, len(self.waiting)))
+
+		# start preparing the sources for every module right away,
+		# in parallel with the compilation of their dependencies
+		self.prep_pool = ThreadPoolExecutor(max_workers = self._prep_jobs())
+		prep_futures = []
+		for mod in list(self.waiting.values()):
+			# the history records the phases of this build only,
+			# not of earlier ones in watch or daemon mode
+			mod.timings = {}
+			if mod.url and not self._remote(mod) and not self._from_cache(mod):
+				prep_futures.append(self.prep_pool.submit(self._prepare_thread, mod))
+			else:
+				self.prepared[mod.fullname] = mod
+		token_thread = Thread(target = self._token_thread)
+		token_thread.start()
+
+		with self.lock:
+			while True:
+				# queue up everything that has become ready; modules
+				# that were installed during the check are retired
+				# immediately, which might make more of them ready.
+				for mod in ts.get_ready():
+					if mod.fullname in self.waiting:
+						ready.append(mod)
+					else:
+						self.finished.append(mod)
+				ready.sort(key=lambda mod: self.priority[mod.fullname], reverse=True)
+
+				# failed modules are never marked done so that nothing
+				# that depends on them will be started.
+				if len(self.finished) != 0:
+					for mod in self.finished:
+						if mod.fullname in self.start_times:
+							progress = True
+						if not mod.fullname in self.failed:
+							ts.done(mod)
+					self.finished = []
 					continue
 
-				# it is time to build this mod!
-				mod.building = True
-				Thread(target = self._build_thread, args=(mod,)).start()
-				break
+				# in keep going mode the failed modules block only the
+				# modules that depend on them, everything else builds
+				if len(self.failed) == 0 or self.keep_going:
+					self._update_throttle()
+					for mod in self._runnable():
+						if self._free_slots() == 0:
+							break
+						if not self._remote(mod) and self._available_tokens() == 0:
+							continue
+						ready.remove(mod)
+						self._start(mod)
+				else:
+					# nothing else will start, don't take more tokens
+					ready.clear()
+
+				# don't sit on tokens that other makes could be using
+				while len(self.tokens) > self._tokens_wanted():
+					self.jobserver.release(self.tokens.pop())
+
+				if len(self.building) == 0 and len(ready) == 0:
+					# no builders running and nothing else can start
+					break
+
+				if progress:
+					# something finished, print the new state and eta
+					self.report()
+					progress = False
+
+				# poll while the machine is too busy to start anything,
+				# otherwise sleep until a module finishes
+				self.lock.notify_all()
+				self.lock.wait(timeout = 1 if self.throttled else None)
+
+			self.stopping = True
+			self.lock.notify_all()
+
+		token_thread.join()
+		self.pool.shutdown()
+		# don't prepare sources that nothing will build; shutdown()
+		# can't cancel them itself before python 3.9
+		for future in prep_futures:
+			future.cancel()
+		self.prep_pool.shutdown()
+		submodule.recompress_wait(cancel=True)
+		for token in self.tokens:
+			self.jobserver.release(token)
+		self.tokens = []
+		submodule.hash_cache.save()
+
+		return self.report()
+
+	def fetch_all(self):
+		# download every tarball in the graph that isn't already here,
+		# several at a time over a shared pool of connections
+		if self.graph is None:
+			self.check()
 
-			# processed the list of waiting ones sleep for a bit and
-			# try again in a little while
-			sleep(0.1)
+		# modules can share a tarball, so only fetch each url once
+		missing = {}
+		for mod in self.ordered_mods:
+			if not mod.url:
+				continue
+			if mod.fetch(check=True):
+				mod.recompress_later()
+				continue
+			(url,tar) = mod.get_url()
+			missing.setdefault(url, mod)
+
+		if len(missing) == 0:
+			info("FETCH   all tarballs are present")
+			submodule.recompress_wait()
+			return True
+
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=self.fetch_jobs, pool_maxsize=self.fetch_jobs)
+		session.mount("http://", adapter)
+		session.mount("https://", adapter)
+
+		lock = Lock()
+		progress = { "done": 0, "failed": [], "bytes": 0 }
+		start_time = time.time()
+
+		def fetch(mod):
+			ok = False
+			try:
+				ok = mod.fetch(session=session)
+			except Exception as e:
+				print(traceback.format_exc())
+
+			with lock:
+				progress["done"] += 1
+				if ok:
+					progress["bytes"] += os.stat(mod.tar_file).st_size
+				else:
+					progress["failed"].append(mod.fullname)
+				elapsed = max(time.time() - start_time, 0.001)
+				info("FETCHED [%d/%d] %s%s (%.1f MB, %.1f MB/s)" % (
+					progress["done"],
+					len(missing),
+					mod.fullname,
+					"" if ok else " FAILED",
+					progress["bytes"] / 1.0e6,
+					progress["bytes"] / 1.0e6 / elapsed,
+				))
+
+		with ThreadPoolExecutor(max_workers = self.fetch_jobs) as pool:
+			list(pool.map(fetch, missing.values()))
+		session.close()
+		submodule.recompress_wait()
+
+		if len(progress["failed"]) != 0:
+			print(now(), "failed=" + ",".join(progress["failed"]), file=sys.stderr)
+			return False
+		return True
+
+	def preflight(self):
+		# apply every module's patches to scratch copies of the sources
+		# in parallel and report all of the failures, so that a stale
+		# patch is found before the hours of building that lead up to it
+		if self.graph is None:
+			self.check()
+
+		# modules can share their sources, only check each one once
+		mods = {}
+		for mod in self.ordered_mods:
+			if mod.url and len(mod.patches) != 0 and not self._from_cache(mod):
+				mods.setdefault(mod.src_hash, mod)
+
+		scratch_dir = os.path.join(submodule.build_dir, "preflight")
+		start_time = time.time()
+
+		def preflight(mod):
+			scratch = os.path.join(scratch_dir, mod.fullname + "-" + mod.src_hash[0:16])
+			try:
+				return mod.preflight(scratch)
+			except Exception as e:
+				print(traceback.format_exc())
+				return [ "preflight failed: " + str(e) ]
+
+		with ThreadPoolExecutor(max_workers = self._prep_jobs()) as pool:
+			results = list(pool.map(preflight, mods.values()))
+
+		failed = []
+		for (mod, failures) in zip(mods.values(), results):
+			if len(failures) == 0:
+				continue
+			failed.append(mod.fullname)
+			for failure in failures:
+				print(now(), mod.fullname + ": " + failure, file=sys.stderr)
+
+		info("PREFLIGHT %d modules in %.1f seconds" % (len(mods), time.time() - start_time))
+		if len(failed) != 0:
+			print(now(), "failed=" + ",".join(failed), file=sys.stderr)
+			return False
+		return True
 
 	def cache_create(self, cache_dir):
 		self.check()
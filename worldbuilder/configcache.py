@@ -0,0 +1,120 @@
+# Shared cache of autoconf results.
+#
+# Most of the autotools modules run their configure script with the
+# same cross compiler and flags, and each of them probes the same few
+# hundred headers, functions and types from scratch.  The results that
+# autoconf saves in a config.cache are collected here and given to the
+# next configure that runs with the same toolchain.
+#
+# The toolchain identity is the VAR=value arguments on the configure
+# command line along with --host, --build, --target and --with-*, plus
+# the sha256 of the compiler binary, so that rebuilding the compiler or
+# changing the flags or paths starts a new cache.  Each module gets its
+# own copy of the shared cache and what it adds is merged back once it
+# has configured successfully, under a lock since several modules can
+# be configuring at once.
+#
+# The cache doesn't change the out_hash, so modules whose configure
+# scripts misbehave with it should be excluded with the configure_cache
+# argument or $CONFIGURE_CACHE_EXCLUDE.
+import os
+import re
+import shutil
+import fcntl
+from fnmatch import fnmatch
+
+from worldbuilder.util import *
+
+# precious variables are checked against the environment by configure,
+# which fails if they are different from the ones in the cache
+skip_vars = [ "ac_cv_env_*" ]
+
+identity_options = ( "--host=", "--build=", "--target=", "--with-" )
+
+cache_line = re.compile(r'^(?:test "\$\{)?([A-Za-z_][A-Za-z0-9_]*_cv_[A-Za-z0-9_]*)')
+var_arg = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*=')
+
+def read_cache(filename):
+	# the cache variables and the lines that set them
+	entries = {}
+	try:
+		with open(filename, "r") as f:
+			for line in f:
+				m = cache_line.match(line)
+				if not m or any(fnmatch(m[1], pattern) for pattern in skip_vars):
+					continue
+				entries[m[1]] = line
+	except FileNotFoundError:
+		pass
+	return entries
+
+def write_cache(filename, entries):
+	tmp_filename = filename + ".tmp"
+	with open(tmp_filename, "w") as f:
+		for name in sorted(entries):
+			f.write(entries[name])
+	os.rename(tmp_filename, filename)
+
+class ConfigureCache:
+	def __init__(self, cache_dir, exclude=None, file_hash=sha256file):
+		self.cache_dir = cache_dir
+		self.exclude = exclude or []
+		self.file_hash = file_hash
+
+	def enabled(self, mod):
+		return mod.configure_cache and not (mod.name in self.exclude or mod.fullname in self.exclude)
+
+	def compiler_hash(self, args):
+		compiler = "cc"
+		for arg in args:
+			if arg.startswith("CC=") and arg[3:].strip():
+				compiler = arg[3:].split()[0]
+		path = shutil.which(compiler)
+		if path is None:
+			return sha256hex("missing " + compiler)
+		return self.file_hash(os.path.realpath(path))
+
+	def key(self, args):
+		identity = [ arg for arg in args[1:] if var_arg.match(arg) or arg.startswith(identity_options) ]
+		return extend_hashes(extend(None, identity), [ self.compiler_hash(args) ])
+
+	def inject(self, mod, command_list):
+		# returns the commands with --cache-file added to the configure
+		# scripts, and the list of caches to merge back afterwards
+		new_commands = []
+		caches = []
+		for commands in command_list:
+			args = [ mod.format(cmd) for cmd in commands ]
+			if not args[0].endswith("/configure") \
+			or any(arg in ("-C", "--config-cache") or arg.startswith("--cache-file") for arg in args):
+				new_commands.append(commands)
+				continue
+
+			key = self.key(args)
+			cache_file = os.path.join(mod.out_dir, "config.cache")
+			if len(caches) != 0:
+				# more than one configure in the same directory
+				cache_file = os.path.join(mod.out_dir, "config-%d.cache" % (len(caches)))
+			write_cache(cache_file, read_cache(self.shared_file(key)))
+			caches.append((key, cache_file))
+			new_commands.append([ *commands, "--cache-file=" + cache_file ])
+
+		return (new_commands, caches)
+
+	def shared_file(self, key):
+		return os.path.join(self.cache_dir, key + ".cache")
+
+	def merge(self, caches):
+		# add what the configure scripts found to the shared caches
+		mkdir(self.cache_dir)
+		with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			for (key, cache_file) in caches:
+				entries = read_cache(self.shared_file(key))
+				added = read_cache(cache_file)
+				new_vars = len(set(added) - set(entries))
+				if new_vars == 0:
+					continue
+				entries.update(added)
+				write_cache(self.shared_file(key), entries)
+				info("CONFIG  " + relative(self.shared_file(key)) + ": %d new results" % (new_vars))
@@ -0,0 +1,158 @@
+# Resident builder that keeps the module graph in memory.
+#
+# Starting the builder execs all of the module definitions, hashes all
+# of the patches and configs and checks every canary file, which takes
+# longer than a small incremental build.  The daemon does that once and
+# then answers build, check and cache requests from `heads-client` on a
+# Unix socket.  Files that change between requests are found with the
+# watcher, and only the modules that they affect are rehashed.
+#
+# Each request is a single JSON line, like {"command": "build",
+# "args": ["busybox"]}, and the replies are JSON lines with the output
+# of the builder, {"output": "..."}, followed by {"status": 0}.
+# Requests are handled one at a time since they share the Builder.
+import os
+import socket
+import json
+import threading
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+from worldbuilder.util import *
+from worldbuilder import submodule
+from worldbuilder.watch import Watcher
+
+class ClientOutput:
+	def __init__(self, conn):
+		self.conn = conn
+		self.lock = threading.Lock()
+		self.closed = False
+
+	def send(self, message):
+		with self.lock:
+			if self.closed:
+				return
+			try:
+				self.conn.sendall((json.dumps(message) + "\n").encode('utf-8'))
+			except OSError:
+				# the client went away, but the build keeps going
+				self.closed = True
+
+	def write(self, text):
+		if len(text) != 0:
+			self.send({ "output": text })
+		return len(text)
+
+	def flush(self):
+		pass
+
+class Daemon:
+	def __init__(self, builder, socket_path, dirs):
+		self.builder = builder
+		self.socket_path = socket_path
+		self.dirs = dirs
+		self.targets = builder.mods
+		self.running = False
+
+	def update(self):
+		# pick up the changes to the definitions since the last request,
+		# which also resolves the graph again if the targets changed
+		changed = self.watcher.pending()
+		if len(changed) != 0:
+			info("DAEMON  %d files changed" % (len(changed)))
+		if not self.builder.refresh(changed):
+			return False
+		self.watcher.add_files(self.builder.watch_files())
+		return True
+
+	def build(self, targets):
+		self.builder.mods = targets or self.targets
+		if not self.update():
+			return False
+		if len(self.builder.waiting) == 0:
+			# nothing to do, don't check everything again
+			return self.builder.report()
+		return self.builder.build_all()
+
+	def check(self):
+		# forget everything and look at all of the files again
+		self.builder.mods = self.targets
+		if not self.update():
+			return False
+		for mod in self.builder.ordered_mods:
+			mod.invalidate()
+		self.builder.check()
+		return True
+
+	def cache(self):
+		self.builder.mods = self.targets
+		if not self.update():
+			return False
+		return self.builder.cache_create(submodule.cache_dir)
+
+	def command(self, request):
+		command = request.get("command", "build")
+		args = request.get("args", [])
+
+		if command == "build":
+			return self.build(args)
+		if command == "check":
+			return self.check()
+		if command == "cache":
+			return self.cache()
+		if command == "status":
+			return self.builder.report()
+		if command == "stop":
+			self.running = False
+			print("daemon stopping")
+			return True
+
+		print(command + ": unknown command", file=sys.stderr)
+		return False
+
+	def handle(self, conn):
+		with conn, conn.makefile("r") as f:
+			try:
+				request = json.loads(f.readline())
+			except Exception as e:
+				info("DAEMON  bad request: " + str(e))
+				return
+
+			info("DAEMON  " + " ".join([request.get("command", "build"), *request.get("args", [])]))
+			output = ClientOutput(conn)
+			status = False
+			with redirect_stdout(output), redirect_stderr(output):
+				try:
+					status = self.command(request)
+				except SystemExit:
+					# die() has already printed the reason
+					pass
+				except Exception as e:
+					print(traceback.format_exc())
+
+			output.send({ "status": 0 if status else 1 })
+
+	def run(self):
+		self.builder.check()
+		self.watcher = Watcher(self.dirs, self.builder.watch_files())
+
+		if exists(self.socket_path):
+			os.unlink(self.socket_path)
+		mkdir(os.path.dirname(os.path.abspath(self.socket_path)))
+
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(self.socket_path)
+		os.chmod(self.socket_path, 0o600)
+		server.listen(8)
+		info("DAEMON  listening on " + relative(self.socket_path))
+
+		self.running = True
+		try:
+			while self.running:
+				(conn, addr) = server.accept()
+				self.handle(conn)
+		finally:
+			server.close()
+			os.unlink(self.socket_path)
+
+		return True
@@ -0,0 +1,476 @@
+# Distributed builds across several machines.
+#
+# Every module's output is identified by its out_hash, so a module can
+# be built anywhere that has the same module definitions and the install
+# trees of its dependencies.  The coordinator runs the normal Builder
+# scheduler, but instead of building the ready modules itself it queues
+# them for the workers, which poll it over HTTP:
+#
+#   GET  /work?worker=name      long poll for a job, 204 if none, 410 when done
+#   POST /renew/<name>/<hash>    the worker is still building this module
+#   GET  /artifact/<name>/<hash> tar.gz of the install tree of a module
+#   PUT  /result/<name>/<hash>   tar.gz of the install tree, or the failure log
+#
+# where <name> is the module's fullname and <hash> is its out_hash, which
+# must match on both sides.  Every request has to carry the shared
+# secret in the X-Heads-Secret header, since a result is unpacked into
+# an install tree that ends up in the firmware, and the coordinator only
+# listens on localhost unless it is told to bind to another address.
+#
+# Since the install trees are addressed by the out_hash they are kept
+# in the cache directory, but they are packed when they are requested,
+# since some modules (crossgcc, gcc) install into the tree of another
+# module.  Those modules, and any modules that need the build tree of
+# another module, are always built by the coordinator.
+import os
+import re
+import hmac
+import json
+import shutil
+import socket
+import subprocess
+import threading
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from worldbuilder.util import *
+from worldbuilder import submodule
+from worldbuilder.submodule import global_mods
+
+# references to another module's build tree, or installs into its tree
+out_dir_re = re.compile(r"%\(([^)]+)\.(?:out_dir|rout_dir)\)s")
+destdir_re = re.compile(r"DESTDIR=%\(([^)]+)\.install_dir\)s")
+
+def all_commands(mod):
+	for commands in (mod.configure_commands, mod.make_commands, mod.install_commands):
+		for cmd in commands or []:
+			yield from cmd
+
+def trivial(mod):
+	# source only modules, or ones that only symlink things into place,
+	# are cheaper to redo on each worker than to transfer
+	return not mod.configure_commands and not mod.make_commands
+
+secret_header = "X-Heads-Secret"
+
+class Coordinator:
+	def __init__(self, builder, secret, port=8400, bind="127.0.0.1", lease=300, worker_timeout=600):
+		if not secret:
+			raise RuntimeError("the coordinator needs a shared secret for the workers")
+		self.builder = builder
+		self.secret = secret
+		self.port = port
+		self.bind = bind
+		self.lease = lease
+		self.worker_timeout = worker_timeout
+		self.lock = threading.Condition()
+		self.queue = []
+		self.running = {}
+		self.results = {}
+		self.modules = {}
+		self.local = {}
+		self.writers = {}
+		self.done = False
+		self.workers = set()
+		self.finished_workers = set()
+		self.server = None
+
+	def start(self):
+		# must be called after the builder has checked the graph
+		for mod in self.builder.ordered_mods:
+			self.modules[mod.fullname] = mod
+
+		for mod in self.builder.ordered_mods:
+			for cmd in all_commands(mod):
+				for name in out_dir_re.findall(cmd):
+					self.pin(mod, name)
+				for name in destdir_re.findall(cmd):
+					self.pin(mod, name)
+					self.writers.setdefault(global_mods[name].fullname, []).append(mod)
+			if trivial(mod):
+				self.local[mod.fullname] = mod
+
+		handler = type("Handler", (CoordinatorHandler,), { "coordinator": self })
+		self.server = ThreadingHTTPServer((self.bind, self.port), handler)
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		threading.Thread(target=self.expire_leases, daemon=True).start()
+		info("REMOTE  coordinator listening on %s port %d" % (self.bind, self.port))
+
+	def pin(self, mod, name):
+		if not name in global_mods:
+			return
+		self.local[mod.fullname] = mod
+		self.local[global_mods[name].fullname] = global_mods[name]
+
+	def stop(self):
+		with self.lock:
+			self.done = True
+			self.lock.notify_all()
+
+		# give the workers a chance to hear that we're done
+		with self.lock:
+			self.lock.wait_for(lambda: self.workers <= self.finished_workers, timeout=10)
+		self.server.shutdown()
+
+	def remote_ok(self, mod):
+		return not mod.fullname in self.local
+
+	def stamp(self, mod):
+		# the install tree of a module changes when another module
+		# installs into it, so the workers need to fetch it again
+		writers = self.writers.get(mod.fullname, [])
+		return ",".join(sorted([w.fullname for w in writers if w.fullname in self.builder.installed]))
+
+	def build(self, mod):
+		# called from the builder's worker pool
+		info("REMOTE  " + mod.fullname + ": queued for workers")
+		with self.lock:
+			self.queue.append(mod)
+			self.lock.notify_all()
+			queued = time.time()
+			while not mod.fullname in self.results:
+				if not mod in self.queue:
+					# a worker has it, the lease covers it from here
+					queued = time.time()
+				elif time.time() - queued > self.worker_timeout:
+					self.queue.remove(mod)
+					return self.timed_out(mod)
+				self.lock.wait(timeout = 5)
+			(ok, worker) = self.results.pop(mod.fullname)
+
+		if not ok:
+			return False
+
+		info("REMOTE  " + mod.fullname + ": built by " + worker)
+		mod.installed = True
+		return mod
+
+	def timed_out(self, mod):
+		message = "no worker took the job in %d seconds, are any connected to %s port %d?" % (
+			self.worker_timeout, self.bind, self.port)
+		print(now(), mod.fullname + ": " + message, file=sys.stderr)
+		mkdir(mod.out_dir)
+		mod.last_logfile = os.path.join(mod.out_dir, "remote-log")
+		writefile(mod.last_logfile, (message + "\n").encode('utf-8'))
+		return False
+
+	def authorized(self, secret):
+		return secret is not None and hmac.compare_digest(secret.encode('utf-8'), self.secret.encode('utf-8'))
+
+	def take_job(self, worker, timeout=30):
+		with self.lock:
+			self.workers.add(worker)
+			self.lock.wait_for(lambda: self.done or len(self.queue) != 0, timeout=timeout)
+			if self.done:
+				self.finished_workers.add(worker)
+				self.lock.notify_all()
+				return False
+			if len(self.queue) == 0:
+				return None
+
+			mod = self.queue.pop(0)
+			self.running[mod.fullname] = [mod, worker, time.time()]
+
+		deps = []
+		for dep in self.builder.graph.closure(mod.depends):
+			deps.append({
+				"fullname": dep.fullname,
+				"out_hash": dep.out_hash,
+				"stamp": self.stamp(dep),
+			})
+
+		return {
+			"fullname": mod.fullname,
+			"out_hash": mod.out_hash,
+			"depends": deps,
+		}
+
+	def lookup(self, fullname, out_hash, table):
+		# must be called with the lock held
+		if not fullname in table or table[fullname][0].out_hash != out_hash:
+			return None
+		return table[fullname]
+
+	def renew(self, fullname, out_hash):
+		with self.lock:
+			job = self.lookup(fullname, out_hash, self.running)
+			if not job:
+				return False
+			job[2] = time.time()
+			return True
+
+	def expire_leases(self):
+		# put the jobs of workers that have gone away back in the queue
+		while True:
+			time.sleep(self.lease / 4)
+			with self.lock:
+				for (fullname, (mod, worker, renewed)) in list(self.running.items()):
+					if time.time() - renewed < self.lease:
+						continue
+					info("REMOTE  " + mod.fullname + ": lost worker " + worker + ", requeueing")
+					del self.running[fullname]
+					self.queue.insert(0, mod)
+				self.lock.notify_all()
+
+	def artifact(self, fullname, out_hash):
+		mod = self.modules.get(fullname)
+		if not mod or mod.out_hash != out_hash:
+			return None
+		if not mod.fullname in self.builder.installed and not mod.installed:
+			return None
+		return mod
+
+	def put_result(self, fullname, out_hash, ok, rfile, length):
+		with self.lock:
+			job = self.lookup(fullname, out_hash, self.running)
+			if not job:
+				return False
+			(mod, worker, renewed) = job
+
+		if ok:
+			# keep the artifact in the cache under the usual name and
+			# unpack it where the install tree would have been
+			mkdir(submodule.cache_dir)
+			cache_file = os.path.join(submodule.cache_dir, mod.fullname + "-" + mod.out_hash[0:16] + ".tar.gz")
+			with open(cache_file + ".tmp", "wb") as f:
+				copy_stream(rfile, f, length)
+			os.replace(cache_file + ".tmp", cache_file)
+
+			system("rm", "-rf", mod.install_dir)
+			mkdir(mod.install_dir)
+			system("tar", "-zxf", cache_file, "-C", mod.install_dir)
+		else:
+			mkdir(mod.out_dir)
+			mod.last_logfile = os.path.join(mod.out_dir, "remote-log")
+			with open(mod.last_logfile, "wb") as f:
+				copy_stream(rfile, f, length)
+
+		with self.lock:
+			del self.running[fullname]
+			self.results[fullname] = (ok, worker)
+			self.lock.notify_all()
+		return True
+
+def copy_stream(rfile, wfile, length):
+	while length > 0:
+		data = rfile.read(min(length, chunk_size))
+		if not data:
+			raise IOError("short read")
+		wfile.write(data)
+		length -= len(data)
+
+class CoordinatorHandler(BaseHTTPRequestHandler):
+	coordinator = None
+
+	def log_message(self, format, *args):
+		if verbose > 1:
+			info("REMOTE  " + self.address_string() + " " + (format % args))
+
+	def reply(self, code, body=b'', content_type="application/octet-stream"):
+		self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def refuse(self):
+		# every request needs the shared secret
+		if self.coordinator.authorized(self.headers.get(secret_header)):
+			return False
+		info("REMOTE  " + self.address_string() + ": refused " + self.command + " " + self.path)
+		self.reply(403)
+		return True
+
+	def do_GET(self):
+		if self.refuse():
+			return
+		url = urlparse(self.path)
+		query = parse_qs(url.query)
+		parts = url.path.strip("/").split("/")
+
+		if parts == ["work"]:
+			worker = query.get("worker", [self.address_string()])[0]
+			job = self.coordinator.take_job(worker)
+			if job is False:
+				return self.reply(410)
+			if job is None:
+				return self.reply(204)
+			info("REMOTE  " + job["fullname"] + ": sent to " + worker)
+			return self.reply(200, json.dumps(job).encode('utf-8'), "application/json")
+
+		if len(parts) == 3 and parts[0] == "artifact":
+			mod = self.coordinator.artifact(parts[1], parts[2])
+			if not mod:
+				return self.reply(404)
+
+			# no length is known in advance, so the end of the
+			# artifact is the end of the connection
+			self.send_response(200)
+			self.send_header("Content-Type", "application/gzip")
+			self.end_headers()
+			tar = subprocess.Popen(["tar", "-zcf", "-", "-C", mod.install_dir, "."], stdout=subprocess.PIPE)
+			shutil.copyfileobj(tar.stdout, self.wfile, chunk_size)
+			tar.wait()
+			self.close_connection = True
+			return
+
+		return self.reply(404)
+
+	def do_POST(self):
+		if self.refuse():
+			return
+		parts = urlparse(self.path).path.strip("/").split("/")
+		if len(parts) == 3 and parts[0] == "renew":
+			return self.reply(200 if self.coordinator.renew(parts[1], parts[2]) else 404)
+		return self.reply(404)
+
+	def do_PUT(self):
+		if self.refuse():
+			return
+		url = urlparse(self.path)
+		query = parse_qs(url.query)
+		parts = url.path.strip("/").split("/")
+		length = int(self.headers.get("Content-Length", 0))
+
+		if len(parts) == 3 and parts[0] == "result":
+			ok = query.get("status", ["failed"])[0] == "ok"
+			if self.coordinator.put_result(parts[1], parts[2], ok, self.rfile, length):
+				return self.reply(200)
+		return self.reply(404)
+
+class Worker:
+	def __init__(self, builder, url, secret, name=None, lease=300):
+		if not secret:
+			raise RuntimeError("the worker needs the coordinator's shared secret")
+		self.builder = builder
+		self.url = url.rstrip("/")
+		self.name = name or socket.gethostname() + "-" + str(os.getpid())
+		self.lease = lease
+		self.session = requests.Session()
+		self.session.headers[secret_header] = secret
+
+	def run(self):
+		self.builder.check()
+		self.modules = {}
+		for mod in self.builder.ordered_mods:
+			self.modules[mod.fullname] = mod
+
+		info("REMOTE  worker " + self.name + " polling " + self.url)
+		errors = 0
+		while True:
+			try:
+				r = self.session.get(self.url + "/work", params={ "worker": self.name }, timeout=60)
+				errors = 0
+			except requests.exceptions.RequestException as e:
+				info("REMOTE  " + self.url + ": " + str(e))
+				errors += 1
+				if errors > 12:
+					return False
+				time.sleep(5)
+				continue
+
+			if r.status_code == 410:
+				info("REMOTE  coordinator is done")
+				return True
+			if r.status_code == 403:
+				info("REMOTE  " + self.url + ": refused, check the shared secret")
+				return False
+			if r.status_code != 200:
+				continue
+
+			self.build(r.json())
+
+	def job_url(self, kind, job):
+		return self.url + "/" + kind + "/" + job["fullname"] + "/" + job["out_hash"]
+
+	def lookup(self, job):
+		mod = self.modules.get(job["fullname"])
+		if not mod or mod.out_hash != job["out_hash"]:
+			raise RuntimeError(job["fullname"] + ": out_hash " + job["out_hash"] + " does not match the local modules")
+		return mod
+
+	def renew_thread(self, job, stop):
+		while not stop.wait(self.lease / 4):
+			try:
+				self.session.post(self.job_url("renew", job), timeout=30)
+			except requests.exceptions.RequestException as e:
+				pass
+
+	def build(self, job):
+		mod = None
+		stop = threading.Event()
+		threading.Thread(target=self.renew_thread, args=(job, stop), daemon=True).start()
+
+		ok = False
+		try:
+			mod = self.lookup(job)
+			info("REMOTE  " + mod.fullname + ": building")
+			ok = self.prepare(job) and mod.install()
+		except Exception as e:
+			print(traceback.format_exc(), file=sys.stderr)
+			if mod:
+				mkdir(mod.out_dir)
+				mod.last_logfile = os.path.join(mod.out_dir, "remote-log")
+				with open(mod.last_logfile, "a") as f:
+					print(traceback.format_exc(), file=f)
+		stop.set()
+
+		result_url = self.job_url("result", job)
+		if ok:
+			tar_file = os.path.join(mod.out_dir, "artifact.tar.gz")
+			system("tar", "-zcf", tar_file, "-C", mod.install_dir, ".")
+			with open(tar_file, "rb") as f:
+				self.session.put(result_url, params={ "status": "ok" }, data=f)
+			os.unlink(tar_file)
+			info("REMOTE  " + mod.fullname + ": sent")
+		else:
+			log = b'no log'
+			if mod and exists(mod.last_logfile):
+				log = readfile(mod.last_logfile)
+			self.session.put(result_url, params={ "status": "failed" }, data=log)
+			info("REMOTE  " + job["fullname"] + ": failed")
+
+	def prepare(self, job):
+		# make sure that all of the dependencies are available, either
+		# by building the trivial ones or fetching their install trees
+		for dep_job in job["depends"]:
+			dep = self.lookup(dep_job)
+
+			# the dirty sources are only used by their own build
+			if dep.url and (trivial(dep) or not dep.dirty) and not dep.patch():
+				return False
+			if trivial(dep):
+				if not dep.install():
+					return False
+				continue
+
+			stamp_file = os.path.join(dep.install_dir, ".remote-stamp")
+			install_canary = os.path.join(dep.install_dir, ".install-" + dep.name)
+			if exists(install_canary) and (not exists(stamp_file) or readfile(stamp_file).decode('utf-8') == dep_job["stamp"]):
+				# already built here or fetched with the same contents
+				dep.installed = True
+				continue
+
+			self.fetch_artifact(dep)
+			writefile(stamp_file, dep_job["stamp"].encode('utf-8'))
+			dep.installed = True
+
+		return True
+
+	def fetch_artifact(self, dep):
+		info("REMOTE  " + dep.fullname + ": fetching install tree")
+		system("rm", "-rf", dep.install_dir)
+		mkdir(dep.install_dir)
+
+		r = self.session.get(self.url + "/artifact/" + dep.fullname + "/" + dep.out_hash, stream=True, timeout=60)
+		if r.status_code != 200:
+			raise RuntimeError(dep.fullname + ": artifact not available")
+
+		tar = subprocess.Popen(["tar", "-zxf", "-", "-C", dep.install_dir], stdin=subprocess.PIPE)
+		for data in r.iter_content(chunk_size):
+			tar.stdin.write(data)
+		tar.stdin.close()
+		if tar.wait() != 0:
+			raise RuntimeError(dep.fullname + ": artifact did not unpack")
@@ -0,0 +1,104 @@
+# Index of the module dependency graph.
+#
+# Dependencies can be given as module objects or as names that are
+# looked up in the global module list.  Each module is resolved once,
+# when it is first added, and the graph keeps the dependency lists,
+# the reverse dependency lists and a topological order, so that the
+# closure and affected set queries are linear in the size of the part
+# of the graph that they touch, and ordering their results only sorts
+# that part by its position in the order.
+from worldbuilder.util import *
+from worldbuilder.submodule import global_mods
+
+class ModuleGraph:
+	def __init__(self, roots=None):
+		self.nodes = {}
+		self.users = {}
+		self.order = []
+		self.position = {}
+		for root in roots or []:
+			self.add(root)
+
+	def resolve(self, mod, referrer=None):
+		if type(mod) != str:
+			return mod
+		if not mod in global_mods:
+			if referrer:
+				die(mod + ": not found? referenced by " + referrer.fullname)
+			die(mod + ": not found?")
+		return global_mods[mod]
+
+	def resolve_depends(self, mod):
+		# keep the names as they were given so that the graph can be
+		# resolved again after modules have been redefined
+		if mod.depends_spec is None:
+			mod.depends_spec = list(mod.depends)
+		mod.depends = [self.resolve(dep, mod) for dep in mod.depends_spec]
+		return mod.depends
+
+	def add(self, root):
+		# iterative depth first walk so that deep graphs don't hit
+		# the recursion limit; modules are appended to the order
+		# after all of their dependencies.
+		root = self.resolve(root)
+		if root.fullname in self.nodes:
+			return root
+
+		visiting = { root.fullname }
+		stack = [[root, self.resolve_depends(root), 0]]
+
+		while len(stack) != 0:
+			frame = stack[-1]
+			(mod, depends, i) = frame
+
+			if i == len(depends):
+				stack.pop()
+				visiting.remove(mod.fullname)
+				self.nodes[mod.fullname] = mod
+				self.position[mod.fullname] = len(self.order)
+				self.order.append(mod)
+				for dep in depends:
+					self.users.setdefault(dep.fullname, []).append(mod)
+				continue
+
+			frame[2] += 1
+			dep = depends[i]
+			if dep.fullname in self.nodes:
+				continue
+			if dep.fullname in visiting:
+				cycle = [x[0].fullname for x in stack] + [dep.fullname]
+				die("dependency cycle: " + " -> ".join(cycle))
+
+			visiting.add(dep.fullname)
+			stack.append([dep, self.resolve_depends(dep), 0])
+
+		return root
+
+	def ordered(self, names):
+		# the modules in the set, in the order that they can be built
+		names = [name for name in names if name in self.position]
+		return [self.nodes[name] for name in sorted(names, key=self.position.__getitem__)]
+
+	def closure(self, roots):
+		# the roots and everything that they depend on
+		seen = set()
+		todo = [self.add(root) for root in roots]
+		while len(todo) != 0:
+			mod = todo.pop()
+			if mod.fullname in seen:
+				continue
+			seen.add(mod.fullname)
+			todo.extend(mod.depends)
+		return self.ordered(seen)
+
+	def affected(self, roots):
+		# the roots and everything that depends on them
+		seen = set()
+		todo = [self.resolve(root) for root in roots]
+		while len(todo) != 0:
+			mod = todo.pop()
+			if mod.fullname in seen:
+				continue
+			seen.add(mod.fullname)
+			todo.extend(self.users.get(mod.fullname, []))
+		return self.ordered(seen)
@@ -0,0 +1,166 @@
+# Persistent memo of file hashes.
+#
+# The patches, config files and initrd inputs are hashed on every run,
+# which means reading all of the kernel and coreboot patch series and
+# several MB of binaries before any work starts.  The memo remembers
+# the sha256 of each file along with its size, mtime and inode, and the
+# file is only read again if any of those have changed.
+#
+# A file that is written while it is being hashed could end up with a
+# hash of the old contents and the new stat, so the file is stat'ed
+# before and after reading it and the hash is only remembered if they
+# match.  Files modified in the last few seconds aren't remembered
+# either, since another write in the same mtime tick would not change
+# the stat, the same as git's "racy clean" check.
+#
+# The memo is a JSON file in the build directory that is merged with
+# the one on disk and replaced atomically while holding a lock, so
+# that concurrent builders can share it.
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+
+from worldbuilder.util import *
+
+# files modified more recently than this aren't remembered
+racy_seconds = 2
+
+def stat_key(st):
+	return [ st.st_size, st.st_mtime_ns, st.st_ino ]
+
+class HashCache:
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.entries = None
+		self.updates = {}
+
+	def load(self):
+		# must be called with the lock held
+		if self.entries is not None:
+			return self.entries
+		self.entries = self.read()
+		return self.entries
+
+	def read(self):
+		try:
+			with open(self.filename, "r") as f:
+				return json.load(f)
+		except FileNotFoundError:
+			return {}
+		except Exception as e:
+			info("HASHES  " + relative(self.filename) + ": ignoring unreadable memo: " + str(e))
+			return {}
+
+	def lookup(self, filename, st):
+		with self.lock:
+			entry = self.load().get(filename)
+		if entry and entry[0:3] == stat_key(st):
+			return entry[3]
+		return None
+
+	def remember(self, filename, before, after, file_hash):
+		if stat_key(before) != stat_key(after):
+			# modified while it was being read
+			return
+		if time.time_ns() - after.st_mtime_ns < racy_seconds * 1000000000:
+			return
+		entry = stat_key(after) + [ file_hash ]
+		with self.lock:
+			self.load()[filename] = entry
+			self.updates[filename] = entry
+
+	def file_hash(self, filename):
+		# the sha256hex of the file, reading it only if it has changed
+		filename = os.path.abspath(filename)
+		before = os.stat(filename)
+		file_hash = self.lookup(filename, before)
+		if file_hash:
+			return file_hash
+
+		file_hash = sha256file(filename)
+		self.remember(filename, before, os.stat(filename), file_hash)
+		return file_hash
+
+	def data_hash(self, filename, before, data):
+		# for callers that need the contents anyway; before is
+		# the stat of the file from before it was read
+		filename = os.path.abspath(filename)
+		file_hash = self.lookup(filename, before)
+		if file_hash:
+			return file_hash
+
+		file_hash = sha256hex(data)
+		self.remember(filename, before, os.stat(filename), file_hash)
+		return file_hash
+
+	@contextmanager
+	def locked(self):
+		# serialize the updates from all of the builders
+		mkdir(os.path.dirname(os.path.abspath(self.filename)))
+		with open(self.filename + ".lock", "w") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			yield
+
+	def write(self, entries):
+		# must be called with the file locked
+		tmp_filename = self.filename + ".tmp"
+		with open(tmp_filename, "w") as f:
+			json.dump(entries, f, sort_keys=True)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmp_filename, self.filename)
+
+	def save(self):
+		with self.lock:
+			if len(self.updates) == 0:
+				return True
+			updates = self.updates
+			self.updates = {}
+
+		with self.locked():
+			# merge with anything that other builders have saved
+			entries = self.read()
+			entries.update(updates)
+			self.write(entries)
+
+		with self.lock:
+			self.entries = entries
+			self.entries.update(self.updates)
+		return True
+
+	def verify(self):
+		# rehash everything that the memo says is unchanged and report
+		# the entries that are wrong; stale ones are dropped.
+		with self.lock:
+			self.entries = self.read()
+			entries = dict(self.entries)
+
+		bad = 0
+		stale = 0
+		for (filename, entry) in sorted(entries.items()):
+			try:
+				st = os.stat(filename)
+			except OSError:
+				st = None
+			if st is None or entry[0:3] != stat_key(st):
+				stale += 1
+				del entries[filename]
+				continue
+
+			file_hash = sha256file(filename)
+			if file_hash != entry[3]:
+				print(relative(filename) + ": memo " + entry[3] + " != " + file_hash, file=sys.stderr)
+				bad += 1
+				del entries[filename]
+
+		with self.locked():
+			self.write(entries)
+
+		with self.lock:
+			self.entries = entries
+
+		print(relative(self.filename) + ": %d good, %d stale, %d bad" % (len(entries), stale, bad))
+		return bad == 0
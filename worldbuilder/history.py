@@ -0,0 +1,120 @@
+# Record of how long each module took to build so that the scheduler
+# can estimate the critical path through the graph on the next run,
+# the builder can print an ETA, and slow builds can be spotted.
+#
+# The history is an append-only file of JSON records, one per line,
+# so that concurrent builders and interrupted runs can't corrupt it.
+# Each record has the time of each of the build phases of the module.
+import os
+import json
+import socket
+import threading
+from statistics import median
+
+from worldbuilder.util import *
+
+# modules that have never been built are assumed to take this long
+default_duration = 60
+
+phases = [ "fetch", "unpack", "patch", "configure", "make", "install" ]
+
+class History:
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.host = socket.gethostname()
+		self.records = []
+		self.durations = {}
+		self.load()
+
+	def load(self):
+		if not exists(self.filename):
+			return self
+
+		with open(self.filename, "r") as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except Exception as e:
+					# partial line from an interrupted run
+					continue
+				self.add(record)
+
+		return self
+
+	def add(self, record):
+		self.records.append(record)
+		if record.get("status", "ok") == "ok":
+			self.durations[record["fullname"]] = record["seconds"]
+
+	def record(self, mod, start_time, seconds, ok=True):
+		record = {
+			"time": int(start_time),
+			"fullname": mod.fullname,
+			"out_hash": mod.out_hash,
+			"host": self.host,
+			"status": "ok" if ok else "failed",
+			"seconds": round(seconds, 3),
+			"phases": { phase: round(t, 3) for (phase,t) in mod.timings.items() },
+		}
+
+		with self.lock:
+			self.add(record)
+			mkdir(os.path.dirname(self.filename))
+			with open(self.filename, "a") as f:
+				f.write(json.dumps(record) + "\n")
+
+	def duration(self, mod):
+		return self.durations.get(mod.fullname, default_duration)
+
+	def regressions(self, threshold=1.25, min_seconds=10):
+		# compare the latest successful build of each module on this
+		# host against the median of the ones before it
+		runs = {}
+		for record in self.records:
+			if record.get("status", "ok") != "ok":
+				continue
+			if record.get("host", self.host) != self.host:
+				continue
+			runs.setdefault(record["fullname"], []).append(record)
+
+		slow = []
+		for (fullname, records) in runs.items():
+			if len(records) < 2:
+				continue
+			last = records[-1]
+			previous = median([r["seconds"] for r in records[:-1]])
+			if last["seconds"] < previous * threshold or last["seconds"] - previous < min_seconds:
+				continue
+
+			# find the phase that grew the most
+			worst = None
+			worst_delta = 0
+			for phase in phases:
+				before = median([r.get("phases", {}).get(phase, 0) for r in records[:-1]])
+				delta = last.get("phases", {}).get(phase, 0) - before
+				if delta > worst_delta:
+					worst = phase
+					worst_delta = delta
+
+			slow.append([fullname, previous, last, worst, worst_delta])
+
+		return sorted(slow, key=lambda x: x[2]["seconds"] - x[1], reverse=True)
+
+	def report(self, threshold=1.25):
+		slow = self.regressions(threshold)
+		for (fullname, previous, last, worst, worst_delta) in slow:
+			line = "%-32s %7d -> %7d seconds (%+d%%)" % (
+				fullname,
+				previous,
+				last["seconds"],
+				100 * (last["seconds"] - previous) / max(previous, 1),
+			)
+			if worst:
+				line += " %s %+d seconds" % (worst, worst_delta)
+			print(line)
+
+		if len(slow) == 0:
+			print(relative(self.filename) + ": no regressions in %d builds" % (len(self.records)))
+
+		return len(slow) == 0
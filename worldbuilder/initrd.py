@@ -5,6 +5,7 @@ import sys
 
 from worldbuilder.util import *
 from worldbuilder.submodule import Submodule
+from worldbuilder import submodule
 
 class Initrd(Submodule):
 	def __init__(self,
@@ -81,9 +82,14 @@ class Initrd(Submodule):
 			print("FAIL    " + dep.name + ": file not found " + relative(fullname), file=sys.stderr)
 			return False
 
+		st = os.stat(fullname)
 		image = readfile(fullname)
 		mode = 0o700 # os.stat(fullname).st_mode  # we're all root here
-		file_hash = sha256hex(image)
+		# the dependency's manifest usually has the hash already
+		manifest = dep.manifest()
+		file_hash = manifest and manifest.file_hash(fullname)
+		if not file_hash:
+			file_hash = submodule.hash_cache.data_hash(fullname, st, image)
 
 		# quick check for path names
 		if image.find(b'/home/ubuntu') != -1:
@@ -131,6 +137,7 @@ class Initrd(Submodule):
 		if check:
 			return False
 
+		start_time = time.time()
 		self.cpio = cpiofile.CPIO()
 
 		# first thing make any directories
@@ -181,6 +188,7 @@ class Initrd(Submodule):
 		writefile(initrd_file + ".hashes", hash_list)
 
 		writefile(build_canary, b'')
+		self.timings["make"] = time.time() - start_time
 		self.built = True
 
 		info("INSTALL  " + self.name + ": " + sha256hex(image))
@@ -0,0 +1,121 @@
+# GNU make jobserver client
+#
+# When the builder is invoked from `make -jN`, the MAKEFLAGS environment
+# variable describes a pipe (or a named fifo with newer versions of make)
+# that holds N-1 tokens.  Every process that wants to run a job in parallel
+# reads a token out of it and writes it back when the job is done; every
+# client also has one implicit token that it does not need to read.
+#
+# The Builder takes a token for each module that it starts beyond the
+# first, and the make processes that the modules invoke inherit MAKEFLAGS
+# and the file descriptors (see `util.system`) so that everything shares
+# one CPU budget.
+#
+# If there is no jobserver in the environment then a private one is
+# created and advertised in MAKEFLAGS so that the child makes still
+# run in parallel without oversubscribing the machine.
+import os
+import re
+import select
+
+from worldbuilder.util import info
+
+class JobServer:
+	def __init__(self, jobs=None, makeflags=None):
+		if makeflags is None:
+			makeflags = os.getenv("MAKEFLAGS", "")
+
+		self.read_fd = None
+		self.write_fd = None
+		self.reader = None
+		self.jobs = None
+
+		if not self.parse(makeflags):
+			self.create(jobs or os.cpu_count() or 1)
+
+	def parse(self, makeflags):
+		# the last --jobserver-auth is the one that is in effect,
+		# older versions of make use --jobserver-fds instead
+		auth = re.findall(r"--jobserver-(?:auth|fds)=(\S+)", makeflags)
+		if len(auth) == 0:
+			return False
+		auth = auth[-1]
+
+		try:
+			if auth.startswith("fifo:"):
+				# our own open file description, so it is safe
+				# to make it non-blocking
+				fd = os.open(auth[5:], os.O_RDWR | os.O_NONBLOCK)
+				self.read_fd = fd
+				self.write_fd = fd
+				self.reader = fd
+			else:
+				(r,w) = auth.split(",")
+				self.read_fd = int(r)
+				self.write_fd = int(w)
+
+				# make closes the fds for commands that it doesn't
+				# think are recursive makes (no `+` in the recipe)
+				os.fstat(self.read_fd)
+				os.fstat(self.write_fd)
+				self.reader = self.private_reader(self.read_fd)
+		except Exception as e:
+			info("JOBS    ignoring unusable jobserver " + auth + ": " + str(e))
+			self.read_fd = self.write_fd = None
+			return False
+
+		jobs = re.findall(r"(?:^|\s)-j(\d+)", makeflags)
+		if len(jobs) != 0:
+			self.jobs = int(jobs[-1])
+
+		info("JOBS    using make jobserver " + auth)
+		return True
+
+	def create(self, jobs):
+		(r,w) = os.pipe()
+		os.set_inheritable(r, True)
+		os.set_inheritable(w, True)
+		self.read_fd = r
+		self.write_fd = w
+		self.reader = self.private_reader(r)
+		self.jobs = jobs
+
+		# the implicit token is ours, the rest go in the pipe
+		os.write(w, b'+' * (jobs - 1))
+
+		makeflags = os.getenv("MAKEFLAGS", "")
+		makeflags = re.sub(r"(?:^|\s)-j\d*", "", makeflags)
+		os.environ["MAKEFLAGS"] = ("-j%d --jobserver-auth=%d,%d " % (jobs, r, w) + makeflags).strip()
+
+		info("JOBS    created jobserver with %d jobs" % (jobs))
+
+	def private_reader(self, fd):
+		# the pipe is shared with the other makes, which expect it to
+		# block, and another one can take the token between select()
+		# and read().  opening it again through /proc gives a file
+		# description of our own that can be made non-blocking.
+		try:
+			return os.open("/proc/self/fd/%d" % (fd), os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+		except OSError as e:
+			info("JOBS    unable to reopen the jobserver pipe, reads might block: " + str(e))
+			return fd
+
+	def acquire(self, stop=None):
+		# wait for a token, checking every so often if the caller
+		# no longer needs one so that the token isn't lost
+		while True:
+			if stop and stop():
+				return None
+			try:
+				(readable,_,_) = select.select([self.reader], [], [], 0.5)
+				if len(readable) == 0:
+					continue
+				token = os.read(self.reader, 1)
+			except (BlockingIOError, InterruptedError):
+				# some other process won the race for it
+				continue
+			if len(token) == 1:
+				return token
+
+	def release(self, token):
+		os.write(self.write_fd, token)
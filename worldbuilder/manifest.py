@@ -0,0 +1,125 @@
+# Manifest of the files in an install directory.
+#
+# When a module is installed, everything in its install directory is
+# listed in a manifest with the mode, size and sha256 of each file and
+# the target of each symlink, so that the report of the hashes, the
+# initrd and anything else that needs the hashes of the installed files
+# doesn't have to read and hash them again.
+#
+# The manifest is a text file sorted by path, one entry per line:
+#
+#	path <tab> mode <tab> size <tab> sha256 <tab> target
+#
+# with the mode in octal (including the file type bits), "-" for the
+# hash of anything that isn't a regular file and for the target of
+# anything that isn't a symlink.  Tabs, newlines and backslashes in
+# the names are escaped with backslashes.
+import os
+import stat
+
+from worldbuilder.util import *
+
+manifest_prefix = ".manifest-"
+
+# canaries and manifests in the top of the install directory
+# are bookkeeping, not part of what was installed
+skip_prefixes = [ ".install-", ".cache-", ".remote-stamp", manifest_prefix ]
+
+def escape(name):
+	return name.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+def unescape(name):
+	out = []
+	i = 0
+	while i < len(name):
+		c = name[i]
+		if c == "\\" and i + 1 < len(name):
+			i += 1
+			c = { "t": "\t", "n": "\n" }.get(name[i], name[i])
+		out.append(c)
+		i += 1
+	return "".join(out)
+
+class Manifest:
+	def __init__(self, filename, root=None):
+		self.filename = filename
+		self.root = root or os.path.dirname(filename)
+		self.entries = {}
+		self.mtime_ns = None
+
+	def scan(self):
+		# hash everything in the install directory
+		self.entries = {}
+		for (dirname, subdirs, filenames) in os.walk(self.root):
+			subdirs.sort()
+			for name in subdirs + filenames:
+				path = os.path.join(dirname, name)
+				rel = os.path.relpath(path, self.root)
+				if dirname == self.root and any(name.startswith(prefix) for prefix in skip_prefixes):
+					continue
+
+				st = os.lstat(path)
+				file_hash = "-"
+				target = "-"
+				if stat.S_ISREG(st.st_mode):
+					file_hash = sha256file(path)
+				elif stat.S_ISLNK(st.st_mode):
+					target = os.readlink(path)
+
+				self.entries[rel] = [ st.st_mode, st.st_size, file_hash, target ]
+
+		return self
+
+	def write(self):
+		lines = []
+		for rel in sorted(self.entries):
+			(mode, size, file_hash, target) = self.entries[rel]
+			target = target if target == "-" else escape(target)
+			lines.append("%s\t%o\t%d\t%s\t%s\n" % (escape(rel), mode, size, file_hash, target))
+
+		tmp_filename = self.filename + ".tmp"
+		writefile(tmp_filename, "".join(lines).encode('utf-8'))
+		os.rename(tmp_filename, self.filename)
+		self.mtime_ns = os.stat(self.filename).st_mtime_ns
+		return self
+
+	def load(self):
+		self.entries = {}
+		with open(self.filename, "r") as f:
+			for line in f:
+				(rel, mode, size, file_hash, target) = line.rstrip("\n").split("\t")
+				target = target if target == "-" else unescape(target)
+				self.entries[unescape(rel)] = [ int(mode, 8), int(size), file_hash, target ]
+		self.mtime_ns = os.stat(self.filename).st_mtime_ns
+		return self
+
+	def lookup(self, path):
+		# the entry for a path relative to the install directory,
+		# or an absolute path inside of it
+		if os.path.isabs(path):
+			path = os.path.relpath(path, self.root)
+		return self.entries.get(path)
+
+	def file_hash(self, path):
+		# the hash of a regular file from the manifest, if it looks like
+		# it hasn't been changed since then; other modules can install
+		# into the same tree, so the size, mode and mtime are checked
+		entry = self.lookup(path)
+		if entry is None or entry[2] == "-":
+			return None
+		try:
+			st = os.lstat(os.path.join(self.root, path))
+		except OSError:
+			return None
+		if st.st_mode != entry[0] or st.st_size != entry[1] or st.st_mtime_ns > self.mtime_ns:
+			return None
+		return entry[2]
+
+	def verify(self):
+		# returns the list of paths that don't match the install directory
+		current = Manifest(self.filename, self.root).scan()
+		bad = []
+		for rel in sorted(set(self.entries) | set(current.entries)):
+			if self.entries.get(rel) != current.entries.get(rel):
+				bad.append(rel)
+		return bad
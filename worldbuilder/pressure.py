@@ -0,0 +1,81 @@
+# Admission control for the module scheduler.
+#
+# Heavy modules (crossgcc, linux, coreboot) each start many processes,
+# so starting several of them at once on a busy or small host can lead
+# to swapping or the OOM killer.  The kernel's pressure stall information
+# in /proc/pressure reports how much of the time tasks were waiting on
+# the cpu, memory or io, and /proc/loadavg has the run queue length.
+# New modules are held back while any of these are over the limits.
+#
+# Limits are given as "cpu=90,memory=10,io=50,load=16", where the
+# pressures are the "some" avg10 percentages and load is the 1 minute
+# load average.  "none" turns off admission control.
+#
+# The cpu limit is not on by default: a parallel build is supposed to
+# keep every cpu busy, so cpu pressure is high whenever it is going
+# well, and holding modules back then only leaves cpus idle later.
+# Memory and io pressure are the ones that lead to thrashing.
+import os
+
+default_limits = "memory=10,io=60"
+
+class Pressure:
+	def __init__(self, limits=None):
+		if limits is None:
+			limits = os.getenv("PRESSURE_LIMITS", default_limits)
+
+		self.limits = {}
+		if limits == "none":
+			return
+
+		for limit in limits.split(","):
+			if limit == "":
+				continue
+			if not "=" in limit:
+				raise ValueError(limit + ": expected name=value")
+			(name,value) = limit.split("=", 1)
+			if name not in ("cpu", "memory", "io", "load"):
+				raise ValueError(name + ": unknown pressure limit")
+			try:
+				self.limits[name] = float(value)
+			except ValueError:
+				raise ValueError(limit + ": not a number")
+
+		if not "load" in self.limits:
+			self.limits["load"] = 2.0 * (os.cpu_count() or 1)
+
+	def read_psi(self, resource):
+		# "some avg10=1.23 avg60=0.50 avg300=0.10 total=12345"
+		try:
+			with open("/proc/pressure/" + resource, "r") as f:
+				for line in f:
+					words = line.split()
+					if words[0] != "some":
+						continue
+					for word in words[1:]:
+						(key,value) = word.split("=")
+						if key == "avg10":
+							return float(value)
+		except Exception as e:
+			# older kernels or psi=0 on the command line
+			pass
+		return None
+
+	def read_load(self):
+		try:
+			with open("/proc/loadavg", "r") as f:
+				return float(f.read().split()[0])
+		except Exception as e:
+			return None
+
+	def check(self):
+		# returns None if it is ok to start another module,
+		# otherwise a description of the pressure that is too high
+		for (name,limit) in self.limits.items():
+			if name == "load":
+				value = self.read_load()
+			else:
+				value = self.read_psi(name)
+			if value is not None and value > limit:
+				return "%s=%.1f > %.1f" % (name, value, limit)
+		return None
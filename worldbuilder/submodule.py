@@ -20,11 +20,17 @@
 # 
 import os
 import sys
+import fcntl
 import requests
-from tempfile import NamedTemporaryFile
 from glob import glob
+from fnmatch import fnmatch
 
 from worldbuilder.util import *
+from worldbuilder.hashcache import HashCache
+from worldbuilder.manifest import Manifest, manifest_prefix
+from worldbuilder.unpack import extract, recompress_zstd, recompress_suffix
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 build_dir = 'build'
 ftp_dir = os.path.join(build_dir, 'ftp')
@@ -34,9 +40,109 @@ cache_dir = os.path.join(build_dir, 'cache')
 install_dir = os.path.join(build_dir, 'install')
 cache_server = None
 
+# shared, read-only store of tarballs by hash that several build
+# trees on the same host can use, laid out like ftp_dir/by-sha256
+ftp_store = None
+hash_cache = HashCache(os.path.join(build_dir, '.hashcache'))
+
+# keep a zstd copy of each tarball next to the original, made in the
+# background after it is fetched, so that unpacking it again is fast
+recompress = False
+recompress_pool = None
+recompress_queued = set()
+recompress_futures = []
+recompress_lock = Lock()
+
+# pristine copies of the patched trees for the dirty modules, by src_hash
+tree_cache = None
+
+# autoconf results shared between modules with the same toolchain
+autoconf_cache = None
+
+def recompress_wait(cancel=False):
+	# wait for the recompression that has started, and the ones that
+	# are queued unless they are cancelled
+	global recompress_pool, recompress_futures
+	with recompress_lock:
+		pool = recompress_pool
+		futures = recompress_futures
+		recompress_pool = None
+		recompress_futures = []
+		recompress_queued.clear()
+	if cancel:
+		# shutdown() can't cancel them itself before python 3.9
+		for future in futures:
+			future.cancel()
+	if pool:
+		pool.shutdown()
+
+def open_lock(filename):
+	# the lock for making filename is kept in a directory next to the
+	# one it is in, so that by-sha256 only ever holds the content
+	(dirname, name) = os.path.split(filename)
+	lock_dir = dirname + ".locks"
+	mkdir(lock_dir)
+	return open(os.path.join(lock_dir, name + ".lock"), "w")
+
+# move all of the build products somewhere else, which must be
+# done before any of the module hashes are computed
+def set_build_dir(new_build_dir):
+	global build_dir, ftp_dir, src_dir, out_dir, cache_dir, install_dir, hash_cache
+	build_dir = new_build_dir
+	ftp_dir = os.path.join(build_dir, 'ftp')
+	src_dir = os.path.join(build_dir, 'src')
+	out_dir = os.path.join(build_dir, 'out')
+	cache_dir = os.path.join(build_dir, 'cache')
+	install_dir = os.path.join(build_dir, 'install')
+	hash_cache = HashCache(os.path.join(build_dir, '.hashcache'))
+
 # global list of modules; names must be unique
 global_mods = {}
 
+# the generic classes are not where modules are defined
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+class_files = [
+	os.path.abspath(__file__),
+	os.path.join(top_dir, "worldbuilder", "initrd.py"),
+]
+
+def definition_files():
+	# the files in the call stack that are part of this tree, which
+	# includes the modules/ file or the script that created the module
+	files = []
+	frame = sys._getframe(1)
+	while frame:
+		filename = os.path.abspath(frame.f_code.co_filename)
+		if filename.startswith(top_dir) and not filename in class_files and not filename in files:
+			files.append(filename)
+		frame = frame.f_back
+	return files
+
+def merge_index(index, other):
+	# the modules in other were visited after the ones in index
+	for (name, deps) in other.items():
+		old = index.get(name)
+		if old is None:
+			index[name] = deps
+		else:
+			index[name] = [dep for dep in old if not dep in deps] + deps
+
+class Substitutions(dict):
+	# a module's own keys, with "name.key" looked up on demand in
+	# the dependency of that name that has the key
+	def __init__(self, keys, index):
+		super().__init__(keys)
+		self.index = index
+
+	def __missing__(self, key):
+		(name, dot, dep_key) = key.rpartition('.')
+		for dep in reversed(self.index.get(name, [])):
+			if dep_key in dep.dict:
+				value = dep.dict[dep_key]
+				self[key] = value
+				return value
+		raise KeyError(key)
+
 class Submodule:
 	def __init__(self,
 		name,
@@ -65,6 +171,7 @@ class Submodule:
 		libs = None,
 		report_hashes = False,
 		cacheable = False,
+		configure_cache = True,
 	):
 		#if not url and not git:
 			#raise RuntimeError("url or git must be specified")
@@ -94,9 +201,12 @@ class Submodule:
 		self.make_commands = make  #or [ "true" ]
 		self.install_commands = install  #or [ "true" ]
 		self.cacheable = cacheable
+		self.configure_cache = configure_cache
 
 		self.depends = depends or []
+		self.depends_spec = None
 		self.dep_files = dep_files or []
+		self.def_files = definition_files()
 		self._bin_dir = "bin" if bin_dir is None else bin_dir
 		self._lib_dir = "lib" if lib_dir is None else lib_dir
 		self._inc_dir = "include" if inc_dir is None else inc_dir
@@ -129,6 +239,8 @@ class Submodule:
 		self.inc_dir = None
 		self.top_dir = build_dir
 		self.last_logfile = "NONE"
+		self.timings = {}
+		self._manifest = None
 
 		self.fetched = False
 		self.unpacked = False
@@ -178,7 +290,7 @@ class Submodule:
 		if len(version) > 2:
 			self.patchver = version[2]
 
-		self.dict = {
+		self.dict = Substitutions({
 			"version": self.version,
 			"name": self.name,
 			"fullname": self.fullname,
@@ -196,81 +308,236 @@ class Submodule:
 			"inc_dir":  self.inc_dir,
 			"bin_dir":  self.bin_dir,
 			"top_dir": self.top_dir,
-		}
+		}, self.update_dep_index())
 
-		return self.update_dep_dict(self.depends)
+		return self.deps_ready
 
-	# recursively add the dependency keys
-	def update_dep_dict(self,deps):
+	# index the dependencies by name for the "name.key" substitutions.
+	# the keys used to be copied depth first from every dependency, so
+	# when several dependencies have the same name the one that was
+	# visited last wins.  each list is in that order, and it is built
+	# from the indices of the dependencies, which have already been
+	# updated since they are hashed first.
+	def update_dep_index(self):
 		ready = True
-		for dep in deps:
+		index = {}
+		for dep in self.depends:
 			if type(dep) is str:
 				# defer this one until later
-				#print("!!!!!!", self.fullname, "dep ", dep, "not ready")
 				ready = False
 				continue
-			for key in dep.dict:
-				if key.count('.') != 0:
-					continue
-				dep_key = dep.name + "." + key
-				if dep_key in self.dict:
-					# this dependency has been processed
-					# should we warn about a replacement key?
-					#if self.dict[dep_key] != dep.dict[key]:
-					#	print("------", self.fullname,": ",dep_key,"!=",self.dict[dep_key],dep.dict[key])
-					pass
-				self.dict[dep_key] = dep.dict[key]
-			# add of of this dependency's dependencies
-			if not self.update_dep_dict(dep.depends):
+			merge_index(index, { dep.name: [dep] })
+			merge_index(index, dep.dep_index)
+			if not dep.deps_ready:
 				ready = False
 
-		return ready
+		self.dep_index = index
+		self.deps_ready = ready
+		return index
 
 	def get_url(self):
 		url = self.format(self.url)
 		(base,f) = os.path.split(url)
 		return (base+"/" + f, f)
 
-	def fetch(self, force=False, check=False):
+	def fetch(self, force=False, check=False, session=None):
 		if not self.url:
 			# this is a fake package with no source
 			self.fetched = True
 			return self
 
 		(url,tar) = self.get_url()
-		dest_tar = os.path.abspath(os.path.join(ftp_dir, tar))
-		self.tar_file = dest_tar
-		if exists(dest_tar) and not force:
+		alias = os.path.abspath(os.path.join(ftp_dir, tar))
+
+		if self.tarhash is None:
+			# no way to know which file it should be, so it
+			# can only be stored under its name
+			self.tar_file = alias
+			if exists(alias) and not force:
+				self.fetched = True
+				return self
+			if check:
+				return False
+			if not self.fetch_file(url, alias, session):
+				return False
 			self.fetched = True
 			return self
 
-		if check:
-			return False
+		# the tarballs are stored by their hash, so the hash is
+		# enough to know that the right file is present, and the
+		# names in ftp_dir are only links for people to look at.
+		stored = os.path.join(os.path.abspath(ftp_dir), "by-sha256", self.tarhash)
+		self.tar_file = stored
+		if exists(stored) and not force:
+			self.fetched = True
+			if not check:
+				self.link_alias(stored, alias)
+				self.recompress_later()
+			return self
 
-		# make sure we have a place to put it
-		mkdir(ftp_dir)
+		shared = ftp_store and os.path.join(ftp_store, "by-sha256", self.tarhash)
+		if shared and exists(shared) and not force:
+			# link it into this tree if possible, otherwise it is
+			# used from the shared store where it is.  checking
+			# doesn't change either tree.
+			self.tar_file = shared
+			self.fetched = True
+			if not check:
+				self.tar_file = self.link_file(shared, stored) or shared
+				self.link_alias(self.tar_file, alias)
+				self.recompress_later()
+			return self
 
-		info("FETCH   " + self.fullname + ": fetching " + url)
+		if exists(alias) and not force:
+			# from before the store; check it once and keep it
+			if sha256file(alias) == self.tarhash:
+				if check:
+					self.tar_file = alias
+					self.fetched = True
+					return self
+				if self.link_file(alias, stored):
+					self.fetched = True
+					self.recompress_later()
+					return self
+			info("FETCH   " + self.fullname + ": " + relative(alias) + " is not " + self.tarhash[0:16])
 
-		r = requests.get(url)
-		if r.status_code != requests.codes.ok:
-			print(url + ": failed!", r.text, file=sys.stderr)
+		if check:
 			return False
-			
-		data = r.content
-
-		if self.tarhash is not None:
-			data_hash = sha256hex(data)
-			if data_hash != self.tarhash:
-				print(tar + ": bad hash! " + data_hash, file=sys.stderr)
-				writefile(dest_tar + ".bad", data)
-				return False
-			#info(tar + ": good hash")
 
-		writefile(dest_tar, data)
+		if not self.fetch_file(url, stored, session):
+			return False
+		self.link_alias(stored, alias)
 		self.fetched = True
+		self.recompress_later()
 		return self
 
+	def fetch_file(self, url, dest, session=None):
+		# download the url to dest, which will only exist once it is
+		# complete and has the right hash.  the partial file is hashed
+		# while it is being written and resumed if it is interrupted.
+		dest_dir = os.path.dirname(dest)
+		mkdir(dest_dir)
+
+		# another module or builder might be fetching the same file
+		with open_lock(dest) as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			if exists(dest):
+				return True
+
+			info("FETCH   " + self.fullname + ": fetching " + url)
+			start_time = time.time()
+
+			part = dest + ".part"
+			try:
+				data_hash = download(url, part, session)
+			except requests.exceptions.RequestException as e:
+				print(url + ": failed! " + str(e), file=sys.stderr)
+				return False
+			if data_hash is None:
+				return False
+
+			if self.tarhash is not None:
+				if data_hash != self.tarhash:
+					print(url + ": bad hash! " + data_hash, file=sys.stderr)
+					os.rename(part, dest + ".bad")
+					return False
+				#info(tar + ": good hash")
+
+			os.rename(part, dest)
+			fsync_dir(dest_dir)
+
+		self.timings["fetch"] = time.time() - start_time
+		return True
+
+	def link_file(self, src, dest):
+		# hardlink src to dest, replacing whatever was there;
+		# returns dest or None if they can't be linked
+		try:
+			if exists(dest) and os.path.samefile(src, dest):
+				return dest
+			mkdir(os.path.dirname(dest))
+			tmp = dest + ".link"
+			if os.path.lexists(tmp):
+				os.unlink(tmp)
+			os.link(src, tmp)
+			os.rename(tmp, dest)
+			return dest
+		except OSError as e:
+			return None
+
+	def link_alias(self, stored, alias):
+		if not self.link_file(stored, alias):
+			info("FETCH   " + self.fullname + ": unable to link " + relative(alias))
+
+	def fast_tar_files(self):
+		# where the recompressed copy is made, and where another
+		# build tree might have made one in the shared store
+		name = self.tarhash + recompress_suffix
+		fast_files = [ os.path.join(os.path.abspath(ftp_dir), "by-sha256", name) ]
+		if ftp_store:
+			fast_files.append(os.path.join(ftp_store, "by-sha256", name))
+		return fast_files
+
+	def fast_tar_file(self):
+		# the recompressed copy of the tarball if there is one and it
+		# has the hash that was recorded when it was made.  only the
+		# original is checked against the tarhash.
+		if self.tarhash is None:
+			return None
+		for fast in self.fast_tar_files():
+			try:
+				fast_hash = readfile(fast + ".sha256").decode('utf-8').strip()
+				if hash_cache.file_hash(fast) == fast_hash:
+					return fast
+			except OSError:
+				continue
+			info("UNPACK  " + self.fullname + ": " + relative(fast) + ": bad hash, ignoring it")
+		return None
+
+	def recompress_later(self):
+		global recompress_pool
+		if not recompress or self.tarhash is None:
+			return
+		with recompress_lock:
+			if self.tarhash in recompress_queued:
+				return
+			recompress_queued.add(self.tarhash)
+			if recompress_pool is None:
+				# the decoder and zstd both use all of the cpus
+				recompress_pool = ThreadPoolExecutor(max_workers = 1)
+			recompress_futures.append(recompress_pool.submit(self.recompress))
+
+	def recompress(self):
+		if self.fast_tar_file():
+			return True
+		fast = self.fast_tar_files()[0]
+		try:
+			# another builder might be recompressing the same file
+			with open_lock(fast) as lock:
+				fcntl.flock(lock, fcntl.LOCK_EX)
+				if self.fast_tar_file():
+					return True
+
+				start_time = time.time()
+				fast_hash = recompress_zstd(self.tar_file, fast)
+				if fast_hash is None:
+					return False
+
+				# the hash is written after the copy, so it is
+				# only used once it is complete
+				writefile(fast + ".sha256.tmp", (fast_hash + "\n").encode('utf-8'))
+				os.rename(fast + ".sha256.tmp", fast + ".sha256")
+
+			info("RECOMP  " + self.fullname + ": %.1f MB -> %.1f MB in %.1f seconds" % (
+				os.stat(self.tar_file).st_size / 1.0e6,
+				os.stat(fast).st_size / 1.0e6,
+				time.time() - start_time,
+			))
+			return True
+		except Exception as e:
+			print(self.fullname + ": recompress failed: " + str(e), file=sys.stderr)
+			return False
+
 	def unpack(self, check=False):
 		if not self.url:
 			# this is a fake package with no source
@@ -292,17 +559,31 @@ class Submodule:
 			info("CLEANUP " + self.fullname)
 			system("rm", "-rf", self.src_dir)
 
+			# an identical tree might already be patched, in which
+			# case the canaries for both steps are copied with it
+			start_time = time.time()
+			if tree_cache and tree_cache.clone(self.src_hash, self.src_dir):
+				info("CLONE   " + self.fullname + ": " + self.src_hash[0:16] + " -> " + relative(self.src_dir))
+				self.timings["unpack"] = time.time() - start_time
+				self.unpacked = True
+				return self
+
 		mkdir(self.src_dir)
 
-		info("UNPACK  " + self.fullname + ": " + relative(self.tar_file) + " -> " + relative(self.src_dir))
-		system("tar",
-			"-xf", self.tar_file,
-			"-C", self.src_dir,
-			"--strip-components", "%d" % (self.strip_components),
-			*self.tar_options,
+		# the recompressed copy is much faster to decode, if there is one
+		tar_file = self.fast_tar_file() or self.tar_file
+		info("UNPACK  " + self.fullname + ": " + relative(tar_file) + " -> " + relative(self.src_dir))
+		start_time = time.time()
+		speed = extract(tar_file, self.src_dir,
+			strip_components = self.strip_components,
+			tar_options = self.tar_options,
 		)
+		info("UNPACK  " + self.fullname + ": " + speed)
 
-		writefile(unpack_canary, b'')
+		# the canary only appears once everything is unpacked
+		writefile(unpack_canary + ".tmp", b'')
+		os.rename(unpack_canary + ".tmp", unpack_canary)
+		self.timings["unpack"] = time.time() - start_time
 		self.unpacked = True
 		return self
 
@@ -327,26 +608,144 @@ class Submodule:
 			return self
 
 		mkdir(self.out_dir)
+		start_time = time.time()
 
-		for (patch_file,patch) in self.patches:
+		for (patch_file, patch_hash) in zip(self.patches, self.patch_hashes):
+			# apply exactly what went into the src_hash
+			data = self.read_patch(patch_file, patch_hash)
+			if data is None:
+				return False
 			info("PATCH   " + self.fullname + ": " + relative(patch_file))
-
-			with NamedTemporaryFile() as tmp:
-				tmp.write(patch)
-				tmp.flush()
-
-				system("patch",
-					"--input", tmp.name,
-					"--directory", self.src_dir,
-					"-p%d" % (self.patch_level),
-					log=os.path.join(self.out_dir, "patch-log")
-				)
+			system("patch",
+				"--directory", self.src_dir,
+				"-p%d" % (self.patch_level),
+				log=os.path.join(self.out_dir, "patch-log"),
+				input=data,
+			)
 
 		writefile(patch_canary, b'')
+		self.timings["patch"] = time.time() - start_time
+
+		if self.dirty and tree_cache:
+			# before anything is built in it
+			if tree_cache.insert(self.src_hash, self.src_dir):
+				info("TREES   " + self.fullname + ": cached " + self.src_hash[0:16])
 		if len(self.patch_files) > 0:
 			self.patched = True
 		return self
 
+	def read_patch(self, patch_file, patch_hash):
+		# the contents of the patch, if they are still the same as
+		# when the src_hash was computed
+		data = readfile(patch_file)
+		if sha256hex(data) != patch_hash:
+			print(self.fullname + ": " + relative(patch_file) + " changed since it was hashed", file=sys.stderr)
+			return None
+		return data
+
+	def preflight(self, scratch):
+		# apply the patch series to a scratch copy of the sources and
+		# return every hunk that fails, without touching the src_dir
+		if not self.url or len(self.patches) == 0:
+			return []
+		if exists(self.src_dir, '.patched'):
+			return []
+		if tree_cache and exists(tree_cache.tree(self.src_hash) + ".size"):
+			return []
+
+		if not self.fetch():
+			return [ "unable to fetch " + self.get_url()[0] ]
+
+		if os.path.lexists(scratch):
+			system("rm", "-rf", scratch)
+		mkdir(os.path.dirname(scratch))
+
+		if exists(self.src_dir, '.unpacked') and not exists(self.out_dir, "patch-log"):
+			# unpacked and none of the patches have been tried yet
+			system("cp", "-a", "--reflink=auto", self.src_dir, scratch)
+		else:
+			mkdir(scratch)
+			extract(self.fast_tar_file() or self.tar_file, scratch,
+				strip_components = self.strip_components,
+				tar_options = self.tar_options,
+			)
+
+		failures = []
+		for (patch_file, patch_hash) in zip(self.patches, self.patch_hashes):
+			data = self.read_patch(patch_file, patch_hash)
+			if data is None:
+				failures.append(relative(patch_file) + ": changed since it was hashed")
+				break
+
+			# the later patches can depend on the earlier ones, so
+			# they are applied for real instead of with --dry-run
+			p = subprocess.run([ "patch",
+				"--directory", scratch,
+				"-p%d" % (self.patch_level),
+				"--batch",
+				"--forward",
+				"--no-backup-if-mismatch",
+				"--reject-file=-",
+			], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, input=data)
+			if p.returncode == 0:
+				continue
+
+			target = ""
+			reported = False
+			for line in p.stdout.decode('utf-8', 'replace').splitlines():
+				if "can't find file" in line:
+					target = ""
+				if line.startswith("patching file "):
+					target = line[len("patching file "):] + ": "
+				elif "FAILED" in line and line.startswith("Hunk") \
+				or "can't find file" in line \
+				or "Reversed" in line \
+				or "malformed" in line \
+				or "Only garbage" in line:
+					failures.append(relative(patch_file) + ": " + target + line.strip())
+					reported = True
+			if not reported:
+				failures.append(relative(patch_file) + ": patch failed with status %d" % (p.returncode))
+
+		if len(failures) == 0:
+			system("rm", "-rf", scratch)
+		else:
+			info("PREFLIGHT " + self.fullname + ": partly patched tree in " + relative(scratch))
+		return failures
+
+	def uses_files(self, filenames):
+		# returns why the module would be rebuilt if any of these
+		# absolute filenames changed, or None if it would not be
+		for filename in filenames:
+			if filename in self.def_files:
+				return "definition " + relative(filename)
+			for pattern in self.patch_files:
+				if os.path.basename(filename).startswith("."):
+					# glob() skips hidden files, like editor swap files
+					break
+				if fnmatch(filename, os.path.abspath(self.format(pattern))):
+					return "patch " + relative(filename)
+			for config in self.config_files:
+				if filename == os.path.abspath(config):
+					return "config " + relative(filename)
+			for dep_file in self.dep_files:
+				if filename == os.path.abspath(self.format(dep_file)):
+					return "dep_file " + relative(filename)
+		return None
+
+	def input_files(self):
+		# the patch and config files that will be hashed, as far as
+		# they can be found before the dependencies have been hashed
+		names = { "name": self.name, "version": self.version, "fullname": self.fullname }
+		files = list(self.config_files)
+		for pattern in self.patch_files:
+			try:
+				files.extend(glob(pattern % names))
+			except (KeyError, ValueError, TypeError):
+				# depends on something else in the dictionary
+				pass
+		return files
+
 	def compute_src_hash(self):
 		self.src_hash = self.tarhash or zero_hash
 
@@ -367,6 +766,7 @@ class Submodule:
 		self.update_dict()
 
 		self.patches = []
+		self.patch_hashes = []
 		for filename in self.patch_files:
 			expanded = self.format(filename)
 			files = sorted(glob(expanded))
@@ -375,9 +775,10 @@ class Submodule:
 				print(self.fullname + ": no match for " + expanded + "(originally " + filename + ")", file=sys.stderr)
 				#return False
 			for patch_filename in files:
-				patch = readfile(patch_filename)
-				self.patches.append([patch_filename, patch])
-				self.src_hash = extend(self.src_hash, [patch])
+				patch_hash = hash_cache.file_hash(patch_filename)
+				self.patches.append(patch_filename)
+				self.patch_hashes.append(patch_hash)
+				self.src_hash = extend_hashes(self.src_hash, [patch_hash])
 				#print(self.name + ": patch file " + patch_filename, self.src_hash)
 
 	def compute_out_hash(self, config_file_hash = zero_hash):
@@ -386,8 +787,9 @@ class Submodule:
 		# the commands executed to configure the programs,
 		# and any dependencies
 		# todo: should the hash be on the unexpanded append lines?
-		self.configs = readfiles(self.config_files)
-		config_file_hash = extend(config_file_hash, self.configs)
+		# the config files are read when they are used
+		self.config_hashes = [hash_cache.file_hash(config) for config in self.config_files]
+		config_file_hash = extend_hashes(config_file_hash, self.config_hashes)
 
 		# hash the unexpanded the configuration appended lines first
 		for append in self.config_append:
@@ -469,6 +871,8 @@ class Submodule:
 
 	def run_commands(self, logfile_name, command_list):
 		self.last_logfile = os.path.join(self.out_dir, logfile_name)
+		phase = logfile_name.replace("-log", "")
+		start_time = time.time()
 		for commands in command_list:
 			cmds = []
 			for cmd in commands:
@@ -479,6 +883,8 @@ class Submodule:
 				log=self.last_logfile,
 			)
 
+		self.timings[phase] = time.time() - start_time
+
 	def configure(self, check=False):
 		if not self.patch(check):
 			return False
@@ -496,16 +902,27 @@ class Submodule:
 
 		kconfig_file = os.path.join(self.out_dir, self.kconfig_file)
 
+		configs = readfiles(self.config_files)
+		if [sha256hex(config) for config in configs] != self.config_hashes:
+			print(self.fullname + ": config files changed since they were hashed", file=sys.stderr)
+			return False
+
 		# expand the configuration appended lines now
 		for append in self.config_append:
 			#print(self.name + ": adding " + append)
-			self.configs.append(self.format(append).encode('utf-8'))
+			configs.append(self.format(append).encode('utf-8'))
 
-		writefile(kconfig_file, b'\n'.join(self.configs))
+		writefile(kconfig_file, b'\n'.join(configs))
 
 		if self.configure_commands:
 			info("CONFIG  " + self.fullname)
-			self.run_commands("configure-log", self.configure_commands)
+			configure_commands = self.configure_commands
+			caches = []
+			if autoconf_cache and autoconf_cache.enabled(self):
+				(configure_commands, caches) = autoconf_cache.inject(self, configure_commands)
+			self.run_commands("configure-log", configure_commands)
+			if caches:
+				autoconf_cache.merge(caches)
 
 		writefile(config_canary, b'')
 		self.configured = True
@@ -574,7 +991,7 @@ class Submodule:
 		cache_filename = self.fullname + "-" + self.out_hash[0:16] + ".tar.gz"
 		tar_filename = os.path.join(cache_dir, cache_filename)
 		url = cache_server + "/" + cache_filename
-		r = requests.get(url)
+		r = requests.get(url, stream=True)
 		if r.status_code != requests.codes.ok:
 			return False
 
@@ -582,7 +999,7 @@ class Submodule:
 		mkdir(self.install_dir)
 
 		info("CACHED  " + self.fullname + ": " + url)
-		writefile(tar_filename, r.content)
+		writechunks(tar_filename, r.iter_content(chunk_size))
 		system("tar", "-zxf", tar_filename, "-C", self.install_dir)
 
 		return True
@@ -617,14 +1034,16 @@ class Submodule:
 			info("INSTALL " + self.fullname + ": " + relative(self.install_dir) )
 			self.run_commands("install-log", self.install_commands)
 
+		self.write_manifest()
+
 		if self.report_hashes:
 			for filename in self.bins:
 				full_name = os.path.join(self.bin_dir, filename)
-				file_hash = sha256hex(readfile(full_name))
+				file_hash = self.installed_hash(full_name)
 				print(relative(full_name) + ": " + file_hash)
 			for filename in self.libs:
 				full_name = os.path.join(self.bin_dir, filename)
-				file_hash = sha256hex(readfile(full_name))
+				file_hash = self.installed_hash(full_name)
 				print(relative(full_name) + ": " + file_hash)
 
 		writefile(install_canary, b'')
@@ -635,6 +1054,43 @@ class Submodule:
 
 		return self
 
+	def invalidate(self):
+		# forget the hashes and state so that they will be recomputed
+		# after the inputs to this module have changed
+		self.src_hash = zero_hash
+		self.out_hash = zero_hash
+		self.ready = False
+		self.fetched = False
+		self.unpacked = False
+		self.patched = False
+		self.configured = False
+		self.built = False
+		self.installed = False
+		self.building = False
+		self.timings = {}
+
+	def manifest_file(self):
+		return os.path.join(self.install_dir, manifest_prefix + self.name)
+
+	def write_manifest(self):
+		self._manifest = Manifest(self.manifest_file(), self.install_dir).scan().write()
+		return self._manifest
+
+	def manifest(self):
+		# the list of installed files, or None for installs from
+		# before there were manifests
+		if self._manifest is None or self._manifest.filename != self.manifest_file():
+			if not exists(self.manifest_file()):
+				return None
+			self._manifest = Manifest(self.manifest_file(), self.install_dir).load()
+		return self._manifest
+
+	def installed_hash(self, filename):
+		# the hash of an installed file, from the manifest if possible
+		manifest = self.manifest()
+		file_hash = manifest and manifest.file_hash(filename)
+		return file_hash or hash_cache.file_hash(filename)
+
 	def update_hashes(self):
 		self.compute_src_hash()
 		self.compute_out_hash()
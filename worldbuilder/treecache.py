@@ -0,0 +1,128 @@
+# Cache of unpacked and patched source trees.
+#
+# The dirty modules build inside of their source tree, so they unpack
+# and patch a fresh copy for every out_hash even when the src_hash is
+# the same.  After one of them is patched, a pristine copy of the tree
+# is kept here by its src_hash, and the next one with the same sources
+# is cloned from it with `cp --reflink=auto` instead of running tar and
+# patch again.  On filesystems that support reflinks (btrfs, xfs) the
+# clone shares the data with the cache until it is written, elsewhere
+# it is a plain copy, which is still much faster than decompressing.
+#
+# Hardlinks are not used: the builds write into their trees, and a
+# write through a hardlink would change the pristine copy as well.
+# Making the cache read-only wouldn't stop that when building as root.
+#
+# A tree is complete once its size has been written next to it.  The
+# trees are evicted least recently used first to stay under the
+# size limit.  Cloning takes a shared lock on the cache and adding or
+# evicting trees takes an exclusive one, so that a tree isn't removed
+# while it is being copied.
+import os
+import fcntl
+from contextlib import contextmanager
+
+from worldbuilder.util import *
+
+size_units = { "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40 }
+
+def parse_size(size):
+	# "20G", "512M" or a number of bytes
+	size = str(size).strip().upper().rstrip("B")
+	if size[-1:] in size_units:
+		return int(float(size[:-1]) * size_units[size[-1]])
+	return int(size)
+
+def tree_size(dirname):
+	# the space used on the disk, which is an overestimate for
+	# trees that share their data with reflinks
+	size = 0
+	for (subdir, dirs, files) in os.walk(dirname):
+		for name in files + dirs:
+			try:
+				size += os.lstat(os.path.join(subdir, name)).st_blocks * 512
+			except OSError:
+				pass
+	return size
+
+class TreeCache:
+	def __init__(self, cache_dir, max_size):
+		self.cache_dir = cache_dir
+		self.max_size = parse_size(max_size)
+
+	def tree(self, src_hash):
+		return os.path.join(os.path.abspath(self.cache_dir), src_hash)
+
+	@contextmanager
+	def locked(self, mode):
+		mkdir(self.cache_dir)
+		with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+			fcntl.flock(lock, mode)
+			yield
+
+	def clone(self, src_hash, dest):
+		# make dest a copy of the cached tree, returns False if there
+		# isn't one.  dest must not exist, and only appears once the
+		# copy is complete.
+		tmp = dest + ".clone"
+		with self.locked(fcntl.LOCK_SH):
+			tree = self.tree(src_hash)
+			if not exists(tree + ".size"):
+				return False
+			if os.path.lexists(tmp):
+				system("rm", "-rf", tmp)
+			mkdir(os.path.dirname(dest))
+			system("cp", "-a", "--reflink=auto", tree, tmp)
+			# the mtime of the size file is the last use
+			os.utime(tree + ".size")
+		os.rename(tmp, dest)
+		return True
+
+	def insert(self, src_hash, src):
+		# keep a copy of a freshly patched tree, if there isn't one
+		with self.locked(fcntl.LOCK_EX):
+			tree = self.tree(src_hash)
+			if exists(tree + ".size"):
+				return False
+			# anything else is left from an interrupted copy
+			for leftover in [ tree, tree + ".tmp" ]:
+				if os.path.lexists(leftover):
+					system("rm", "-rf", leftover)
+			system("cp", "-a", "--reflink=auto", src, tree + ".tmp")
+			os.rename(tree + ".tmp", tree)
+			# the tree is only used once its size has been written
+			writefile(tree + ".size.tmp", b"%d\n" % (tree_size(tree)))
+			os.rename(tree + ".size.tmp", tree + ".size")
+			self.trim()
+		return True
+
+	def entries(self):
+		# (last use, src_hash, size) for all of the complete trees
+		entries = []
+		for name in os.listdir(self.cache_dir):
+			if not name.endswith(".size"):
+				continue
+			src_hash = name[:-len(".size")]
+			size_file = os.path.join(self.cache_dir, name)
+			try:
+				st = os.stat(size_file)
+				size = int(readfile(size_file))
+			except (OSError, ValueError):
+				continue
+			entries.append((st.st_mtime, src_hash, size))
+		return sorted(entries)
+
+	def trim(self):
+		# must be called with the exclusive lock held
+		entries = self.entries()
+		total = sum(size for (used, src_hash, size) in entries)
+		for (used, src_hash, size) in entries:
+			if total <= self.max_size:
+				break
+			info("TREES   evicting " + src_hash[0:16] + ": %.1f MB" % (size / 1.0e6))
+			tree = self.tree(src_hash)
+			# the size file goes first so that a partial removal
+			# is never mistaken for a complete tree
+			os.unlink(tree + ".size")
+			system("rm", "-rf", tree)
+			total -= size
@@ -0,0 +1,135 @@
+# Extract source tarballs with a parallel decompressor when there is one.
+#
+# `tar -xf` runs the decompressor with a single thread, and xz is slow
+# enough that unpacking the kernel or gcc takes tens of seconds.  The
+# compression is detected from the first bytes of the file and the
+# fastest decoder that is installed is run in front of tar, which still
+# does the extraction so that --strip-components and any other
+# tar_options work the same.  If none of the decoders are installed
+# the data is decompressed in-process with lzma, gzip or bz2.
+#
+# Tarballs that are unpacked over and over can also be recompressed
+# with zstd into a copy next to the original, see recompress_zstd().
+import os
+import shutil
+import subprocess
+import lzma
+import gzip
+import bz2
+
+from worldbuilder.util import *
+
+magic = [
+	[ "xz",    b'\xfd7zXZ\x00' ],
+	[ "zstd",  b'\x28\xb5\x2f\xfd' ],
+	[ "gzip",  b'\x1f\x8b' ],
+	[ "bzip2", b'BZh' ],
+]
+
+# in order of preference, reading the compressed file on stdin
+decoders = {
+	"xz":    [ [ "pixz", "-d" ], [ "xz", "-d", "-T0", "-c" ] ],
+	"zstd":  [ [ "zstd", "-d", "-T0", "-c" ] ],
+	"gzip":  [ [ "pigz", "-d", "-c" ], [ "gzip", "-d", "-c" ] ],
+	"bzip2": [ [ "lbzip2", "-d", "-c" ], [ "pbzip2", "-d", "-c" ], [ "bzip2", "-d", "-c" ] ],
+}
+
+openers = {
+	"xz": lzma.open,
+	"gzip": gzip.open,
+	"bzip2": bz2.open,
+}
+
+def compression(filename):
+	with open(filename, "rb") as f:
+		header = f.read(8)
+	for (name, prefix) in magic:
+		if header.startswith(prefix):
+			return name
+	return None
+
+def decoder(name):
+	for cmd in decoders.get(name, []):
+		if shutil.which(cmd[0]):
+			return cmd
+	return None
+
+def extract(tar_file, dest_dir, strip_components=1, tar_options=None):
+	# returns a description of what was used and how fast it went
+	tar_cmd = [ "tar",
+		"-xf", "-",
+		"-C", dest_dir,
+		"--strip-components", "%d" % (strip_components),
+		*(tar_options or []),
+	]
+
+	name = compression(tar_file)
+	cmd = decoder(name)
+	start_time = time.time()
+
+	with open(tar_file, "rb") as f:
+		if cmd:
+			dec = subprocess.Popen(cmd, stdin=f, stdout=subprocess.PIPE)
+			tar = subprocess.Popen(tar_cmd, stdin=dec.stdout, close_fds=False)
+			dec.stdout.close()
+			if tar.wait() != 0:
+				dec.kill()
+				dec.wait()
+				raise subprocess.CalledProcessError(tar.returncode, tar_cmd)
+			if dec.wait() != 0:
+				raise subprocess.CalledProcessError(dec.returncode, cmd)
+			how = cmd[0]
+		elif name in openers:
+			tar = subprocess.Popen(tar_cmd, stdin=subprocess.PIPE, close_fds=False)
+			try:
+				with openers[name](f) as data:
+					for chunk in iter(lambda: data.read(chunk_size), b''):
+						tar.stdin.write(chunk)
+			finally:
+				tar.stdin.close()
+			if tar.wait() != 0:
+				raise subprocess.CalledProcessError(tar.returncode, tar_cmd)
+			how = "python " + name
+		else:
+			# not compressed, or something that tar knows better
+			system("tar", "-xf", tar_file, *tar_cmd[3:])
+			how = "tar"
+
+	elapsed = max(time.time() - start_time, 0.001)
+	size = os.stat(tar_file).st_size / 1.0e6
+	return "%s %.1f MB in %.1f seconds, %.1f MB/s" % (how, size, elapsed, size / elapsed)
+
+# the level doesn't change how fast zstd decodes, only the size
+recompress_level = 9
+recompress_suffix = ".zst"
+
+def recompress_zstd(tar_file, dest, level=recompress_level):
+	# decode the tarball and compress it again with zstd, which decodes
+	# many times faster than xz or bzip2.  returns the sha256hex of the
+	# new file or None if it can't be done with the tools installed.
+	name = compression(tar_file)
+	cmd = decoder(name)
+	if name is None or name == "zstd" or not cmd or not shutil.which("zstd"):
+		return None
+
+	zstd_cmd = [ "zstd", "-q", "-T0", "-%d" % (level), "-c" ]
+	tmp = dest + ".tmp"
+	with open(tar_file, "rb") as f:
+		dec = subprocess.Popen(cmd, stdin=f, stdout=subprocess.PIPE)
+		enc = subprocess.Popen(zstd_cmd, stdin=dec.stdout, stdout=subprocess.PIPE)
+		dec.stdout.close()
+		try:
+			file_hash = writechunks(tmp, iter(lambda: enc.stdout.read(chunk_size), b''))
+		finally:
+			enc.stdout.close()
+		enc_status = enc.wait()
+		dec_status = dec.wait()
+
+	if dec_status != 0 or enc_status != 0:
+		os.unlink(tmp)
+		if dec_status != 0:
+			raise subprocess.CalledProcessError(dec_status, cmd)
+		raise subprocess.CalledProcessError(enc_status, zstd_cmd)
+
+	os.rename(tmp, dest)
+	return file_hash
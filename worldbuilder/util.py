@@ -14,6 +14,10 @@ def now():
 zero_hash = '0' * 64
 verbose = 1
 
+# large files are read, hashed and copied in pieces of this size so
+# that the memory used doesn't depend on the size of the tarballs
+chunk_size = 1 << 20
+
 def sha256hex(data):
 	#print("hashing %d bytes" % (len(data)), data)
 	if type(data) is str:
@@ -27,7 +31,95 @@ def extend(h, data):
 		h = sha256hex(h + sha256hex(datum))
 	return h
 
-def system(*s, cwd=None, log=None):
+def sha256file(name):
+	h = hashlib.sha256()
+	with open(name, "rb") as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+def writechunks(name, chunks):
+	# write the file while hashing it, for downloads and copies
+	h = hashlib.sha256()
+	with open(name, "wb") as f:
+		for chunk in chunks:
+			h.update(chunk)
+			f.write(chunk)
+	return h.hexdigest()
+
+def copyfile(src, dest):
+	# returns the sha256hex of the data that was copied
+	with open(src, "rb") as f:
+		return writechunks(dest, iter(lambda: f.read(chunk_size), b''))
+
+def download(url, filename, session=None):
+	# download the url into filename, continuing from where an earlier
+	# download was interrupted if the server supports ranges.  returns
+	# the sha256hex of the whole file once it is on the disk, or None
+	# if the server said no.  connection errors are raised and leave
+	# the partial file for the next attempt.
+	session = session or requests
+	for attempt in range(2):
+		h = hashlib.sha256()
+		offset = 0
+		headers = {}
+		if exists(filename):
+			with open(filename, "rb") as f:
+				for chunk in iter(lambda: f.read(chunk_size), b''):
+					h.update(chunk)
+					offset += len(chunk)
+			if offset != 0:
+				headers["Range"] = "bytes=%d-" % (offset)
+
+		r = session.get(url, stream=True, headers=headers, timeout=60)
+		if r.status_code == 416 and offset != 0:
+			# there is nothing after the part we already have
+			return h.hexdigest()
+		if r.status_code == 206 and offset != 0:
+			# "bytes 1234-5678/5679"
+			content_range = r.headers.get("Content-Range", "")
+			if not content_range.startswith("bytes %d-" % (offset)):
+				info(url + ": unexpected range " + content_range + ", starting over")
+				os.unlink(filename)
+				continue
+			info(url + ": resuming at %d bytes" % (offset))
+			mode = "ab"
+		elif r.status_code == requests.codes.ok:
+			# the whole file, even if a range was requested
+			h = hashlib.sha256()
+			mode = "wb"
+		else:
+			print(url + ": failed! status %d" % (r.status_code), file=sys.stderr)
+			return None
+
+		with open(filename, mode) as f:
+			for chunk in r.iter_content(chunk_size):
+				h.update(chunk)
+				f.write(chunk)
+			f.flush()
+			os.fsync(f.fileno())
+
+		return h.hexdigest()
+
+	return None
+
+def fsync_dir(dirname):
+	# make a rename in the directory durable
+	fd = os.open(dirname, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def extend_hashes(h, hashes):
+	# the same as extend() for data that has already been hashed
+	if h is None:
+		h = zero_hash
+	for datum_hash in hashes:
+		h = sha256hex(h + datum_hash)
+	return h
+
+def system(*s, cwd=None, log=None, input=None):
 	if not cwd:
 		cwd = '.'
 	if verbose > 2:
@@ -45,7 +137,7 @@ def system(*s, cwd=None, log=None):
 	# do not close file descriptors, which will allow
 	# communication from sub-make invocations to the make
 	# that invoked us
-	subprocess.run(s, cwd=cwd, check=True, close_fds=False, stdout=logfile, stderr=logfile)
+	subprocess.run(s, cwd=cwd, check=True, close_fds=False, stdout=logfile, stderr=logfile, input=input)
 	if logfile:
 		logfile.close()
 
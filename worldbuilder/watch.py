@@ -0,0 +1,163 @@
+# Watch the module definitions, configs and patches for changes.
+#
+# This uses inotify through ctypes so that there are no extra python
+# dependencies.  inotify watches are not recursive, so every directory
+# under the watched trees gets its own watch, and new directories are
+# added as they are created.  Bursts of events (editors writing a file
+# several times, `git checkout` touching many files) are coalesced into
+# one set of changed files.  If inotify isn't available the trees are
+# polled for changes in their mtimes instead.
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+
+from worldbuilder.util import *
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+event_header = struct.Struct("iIII")
+
+class Watcher:
+	def __init__(self, paths, files=None):
+		# paths are directory trees, files are individual files
+		self.paths = [os.path.abspath(path) for path in paths if exists(path)]
+		self.files = set([os.path.abspath(f) for f in files or []])
+		self.mtimes = {}
+		self.dirs = {}
+		self.fd = None
+
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+			self.inotify_add_watch = libc.inotify_add_watch
+			self.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+			self.fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+			if self.fd < 0:
+				raise OSError(ctypes.get_errno(), "inotify_init1")
+		except Exception as e:
+			info("WATCH   inotify is not available, polling instead: " + str(e))
+			self.fd = None
+			self.mtimes = self.scan()
+			return
+
+		for path in self.paths:
+			for (dirname, subdirs, filenames) in os.walk(path):
+				self.add_dir(dirname)
+		self.add_files(self.files)
+
+	def add_files(self, files):
+		# individual files are watched through their directories
+		files = set([os.path.abspath(f) for f in files])
+		self.files.update(files)
+		if self.fd is None:
+			for filename in files:
+				if not filename in self.mtimes and exists(filename):
+					self.mtimes[filename] = os.stat(filename).st_mtime_ns
+			return
+		for filename in files:
+			self.add_dir(os.path.dirname(filename))
+
+	def add_dir(self, dirname):
+		if dirname in self.dirs.values() or not exists(dirname):
+			return
+		wd = self.inotify_add_watch(self.fd, dirname.encode('utf-8'), watch_mask)
+		if wd < 0:
+			info("WATCH   " + relative(dirname) + ": unable to watch")
+			return
+		self.dirs[wd] = dirname
+
+	def interesting(self, filename):
+		if filename in self.files:
+			return True
+		for path in self.paths:
+			if filename.startswith(path + "/"):
+				return True
+		return False
+
+	def read_events(self):
+		changed = set()
+		while True:
+			try:
+				buf = os.read(self.fd, 65536)
+			except BlockingIOError:
+				return changed
+
+			offset = 0
+			while offset < len(buf):
+				(wd, mask, cookie, length) = event_header.unpack_from(buf, offset)
+				offset += event_header.size
+				name = buf[offset:offset+length].rstrip(b'\0').decode('utf-8')
+				offset += length
+
+				if not wd in self.dirs:
+					continue
+				filename = os.path.join(self.dirs[wd], name)
+				if mask & IN_ISDIR:
+					if mask & (IN_CREATE | IN_MOVED_TO):
+						for (dirname, subdirs, filenames) in os.walk(filename):
+							self.add_dir(dirname)
+							changed.update([os.path.join(dirname, f) for f in filenames])
+					continue
+				if self.interesting(filename):
+					changed.add(filename)
+
+	def scan(self):
+		mtimes = {}
+		for path in self.paths:
+			for (dirname, subdirs, filenames) in os.walk(path):
+				for f in filenames:
+					filename = os.path.join(dirname, f)
+					try:
+						mtimes[filename] = os.stat(filename).st_mtime_ns
+					except OSError:
+						pass
+		for filename in self.files:
+			try:
+				mtimes[filename] = os.stat(filename).st_mtime_ns
+			except OSError:
+				pass
+		return mtimes
+
+	def poll(self):
+		mtimes = self.scan()
+		changed = set()
+		for filename in set(mtimes) | set(self.mtimes):
+			if mtimes.get(filename) != self.mtimes.get(filename):
+				changed.add(filename)
+		self.mtimes = mtimes
+		return changed
+
+	def pending(self):
+		# whatever has changed since the last call, without waiting
+		if self.fd is None:
+			return sorted(self.poll())
+		return sorted(self.read_events())
+
+	def wait(self, settle=0.5):
+		# block until something changes, then keep collecting
+		# changes until things have been quiet for a little while
+		changed = set()
+		while True:
+			if self.fd is None:
+				time.sleep(settle if len(changed) != 0 else 1)
+				new = self.poll()
+			else:
+				timeout = settle if len(changed) != 0 else None
+				(readable,_,_) = select.select([self.fd], [], [], timeout)
+				new = self.read_events() if len(readable) != 0 else set()
+
+			if len(new) == 0 and len(changed) != 0:
+				return sorted(changed)
+			changed.update(new)